@@ -0,0 +1,76 @@
+"""Per-call cost of classifying anemia severity.
+
+Compares the original path, the anemia thresholds built with
+``builder.lookup.build_table`` followed by three boolean masks, against the
+``AnemiaThresholds`` breakpoint table used by ``IronDeficiencyAnemia``.  Both
+run inside a simulation and read simulant ages from the state table.  Run
+with::
+
+    python benchmarks/anemia_thresholds_benchmark.py
+
+"""
+import timeit
+
+import numpy as np
+import pandas as pd
+from vivarium.interface.interactive import setup_simulation
+from vivarium.testing_utilities import TestPopulation
+
+from vivarium_conic_sqlns.components.iron_deficiency import AnemiaThresholds, get_anemia_thresholds
+
+
+class AnemiaSeverity:
+    """Classifies anemia severity through both the lookup table and the breakpoint table."""
+
+    @property
+    def name(self):
+        return 'anemia_severity'
+
+    def setup(self, builder):
+        self.lookup = builder.lookup.build_table(
+            get_anemia_thresholds(),
+            key_columns=[],
+            parameter_columns=[('age', 'age_group_start', 'age_group_end')],
+            value_columns=['severe_threshold', 'moderate_threshold', 'mild_threshold']
+        )
+        self.thresholds = AnemiaThresholds(get_anemia_thresholds())
+        self.pop_view = builder.population.get_view(['age'])
+
+    def legacy_severity(self, index, hemoglobin):
+        anemia = self.lookup(index)
+        mild = (anemia.moderate_threshold <= hemoglobin) & (hemoglobin < anemia.mild_threshold)
+        moderate = (anemia.severe_threshold <= hemoglobin) & (hemoglobin < anemia.moderate_threshold)
+        severe = hemoglobin < anemia.severe_threshold
+        return mild, moderate, severe
+
+    def severity(self, index, hemoglobin):
+        return self.thresholds.get_severity(self.pop_view.get(index).age.values, hemoglobin.values)
+
+
+def make_simulation(size):
+    config = {'population': {'population_size': size, 'age_start': 0, 'age_end': 5},
+              'randomness': {'key_columns': ['entrance_time', 'age']}}
+    return setup_simulation([TestPopulation(), AnemiaSeverity()], config)
+
+
+def main():
+    print(f'{"simulants":>10} {"lookup table (ms)":>18} {"breakpoints (ms)":>17} {"speedup":>8}')
+    for size in [10_000, 100_000, 1_000_000]:
+        simulation = make_simulation(size)
+        anemia = simulation.get_component('anemia_severity')
+        index = simulation.get_population().index
+        hemoglobin = pd.Series(np.random.RandomState(0).normal(110, 15, size=size), index=index)
+
+        mild, moderate, severe = anemia.legacy_severity(index, hemoglobin)
+        severity = anemia.severity(index, hemoglobin)
+        for code, expected in enumerate([mild, moderate, severe], start=1):
+            assert np.array_equal(severity == code, expected.values)
+
+        repeat = 3 if size >= 1_000_000 else 10
+        legacy = min(timeit.repeat(lambda: anemia.legacy_severity(index, hemoglobin), number=1, repeat=repeat))
+        breakpoints = min(timeit.repeat(lambda: anemia.severity(index, hemoglobin), number=1, repeat=repeat))
+        print(f'{size:>10,} {1000 * legacy:>18.2f} {1000 * breakpoints:>17.2f} {legacy / breakpoints:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Per-step cost of the SQ-LNS exposure adjustment.
+
+Compares the original pandas implementation of ``SQLNSEffect.adjust_exposure``
+(five boolean masks turned into indices, five ``.loc`` scatters and a second
+population lookup per ramp group) against the single-pass numpy kernel
+``get_treatment_phase_and_scale``.  Run with::
+
+    python benchmarks/sqlns_effect_benchmark.py
+
+"""
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from vivarium_conic_sqlns.components.sq_lns_intervention import (get_treatment_phase_and_scale, to_nanoseconds,
+                                                                 RAMP_DOWN)
+
+RAMP = 60
+DURATION = pd.Timedelta(days=365.25)
+CLOCK = pd.Timestamp('2022-07-01')
+
+
+def make_population(size, seed=0):
+    rs = np.random.RandomState(seed)
+    start = CLOCK - pd.to_timedelta(rs.randint(0, 2 * 365, size=size), unit='D')
+    start = pd.Series(start).where(rs.uniform(size=size) < 0.5)
+    pop = pd.DataFrame({'sqlns_treatment_start': start, 'sqlns_treatment_end': start + DURATION})
+    effect_size = pd.Series(rs.normal(4.475, 0.328, size=size), index=pop.index)
+    exposure = pd.Series(rs.normal(110, 10, size=size), index=pop.index)
+    return pop, effect_size, exposure
+
+
+def legacy_adjust_exposure(pop, effect_sizes, exposure, permanent=False):
+    index = pop.index
+    ramp_time = pd.Timedelta(days=RAMP)
+    clock = CLOCK
+
+    def ramp_efficacy(idx, invert=False):
+        if idx.empty:
+            return pd.Series()
+        p = pop.loc[idx]
+        growth_rate = 2 / RAMP * np.log(10_000)
+        if invert:
+            ramp_position = ((p['sqlns_treatment_end'] + ramp_time / 2) - clock) / pd.Timedelta(days=1)
+        else:
+            ramp_position = (clock - (p['sqlns_treatment_start'] + ramp_time / 2)) / pd.Timedelta(days=1)
+        scale = 1 / (1 + np.exp(-growth_rate * ramp_position))
+        return scale * effect_sizes[idx]
+
+    effect_size = pd.Series(0, index=index)
+    untreated = pop.loc[(pop['sqlns_treatment_start'].isnull())
+                        | (pop['sqlns_treatment_start'] <= clock)].index
+    ramp_up = pop.loc[(pop['sqlns_treatment_start'] < clock)
+                      & (clock < pop['sqlns_treatment_start'] + ramp_time)].index
+    full_treatment = pop.loc[(pop['sqlns_treatment_start'] + ramp_time <= clock)
+                             & (clock <= pop['sqlns_treatment_end'])].index
+    ramp_down = pop.loc[(pop['sqlns_treatment_end'] < clock)
+                        & (clock < pop['sqlns_treatment_end'] + ramp_time)].index
+    post_treatment = pop.loc[pop['sqlns_treatment_end'] + ramp_time <= clock].index
+
+    effect_size.loc[untreated] = 0
+    effect_size.loc[ramp_up] = ramp_efficacy(ramp_up)
+    effect_size.loc[full_treatment] = effect_sizes.loc[full_treatment]
+    if permanent:
+        effect_size.loc[ramp_down] = effect_sizes[ramp_down]
+        effect_size.loc[post_treatment] = effect_sizes[post_treatment]
+    else:
+        effect_size.loc[ramp_down] = ramp_efficacy(ramp_down, invert=True)
+        effect_size.loc[post_treatment] = 0
+    return exposure + effect_size
+
+
+def vectorized_adjust_exposure(pop, effect_sizes, exposure, permanent=False):
+    phase, scale = get_treatment_phase_and_scale(to_nanoseconds(pop['sqlns_treatment_start']),
+                                                 to_nanoseconds(pop['sqlns_treatment_end']),
+                                                 CLOCK.value, RAMP)
+    if permanent:
+        scale[phase >= RAMP_DOWN] = 1
+    return exposure + scale * effect_sizes.values
+
+
+def main():
+    print(f'{"simulants":>10} {"permanent":>10} {"legacy (ms)":>12} {"vectorized (ms)":>16} {"speedup":>8}')
+    for size in [10_000, 100_000, 1_000_000]:
+        pop, effect_sizes, exposure = make_population(size)
+        for permanent in [False, True]:
+            expected = legacy_adjust_exposure(pop, effect_sizes, exposure, permanent)
+            actual = vectorized_adjust_exposure(pop, effect_sizes, exposure, permanent)
+            np.testing.assert_allclose(actual.values, expected.values)
+
+            repeat = 3 if size >= 1_000_000 else 10
+            legacy = min(timeit.repeat(lambda: legacy_adjust_exposure(pop, effect_sizes, exposure, permanent),
+                                       number=1, repeat=repeat))
+            vectorized = min(timeit.repeat(lambda: vectorized_adjust_exposure(pop, effect_sizes, exposure, permanent),
+                                           number=1, repeat=repeat))
+            print(f'{size:>10,} {str(permanent):>10} {1000 * legacy:>12.2f} '
+                  f'{1000 * vectorized:>16.2f} {legacy / vectorized:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
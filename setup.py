@@ -28,6 +28,8 @@ if __name__ == "__main__":
         'pandas<0.25',
         
         'scipy',
+        'click',
+        'pyyaml',
         'matplotlib',
         'seaborn',
         'jupyter',
@@ -54,5 +56,11 @@ if __name__ == "__main__":
 
         install_requires=install_requirements,
 
+        entry_points={
+            'console_scripts': [
+                'process_sqlns_results=vivarium_conic_sqlns.verification_and_validation.cli:process_results',
+            ],
+        },
+
         zip_safe=False,
     )
@@ -1,7 +1,13 @@
+import numpy as np
 import pandas as pd
 
 from vivarium_public_health.risks import Risk
 
+from .sq_lns_intervention import NAT, TREATMENT_PHASES
+from .utilities import SampleCounts, SamplingSchedule, SimulantArray
+
+ANEMIA_SEVERITIES = ['unexposed', 'mild', 'moderate', 'severe']
+
 
 class IronDeficiencyAnemia(Risk):
 
@@ -13,7 +19,8 @@ class IronDeficiencyAnemia(Risk):
                     'sample_date': {
                         'month': 7,
                         'day': 1,
-                    }
+                    },
+                    'by_treatment_phase': False,
                 }
             }
         })
@@ -25,12 +32,7 @@ class IronDeficiencyAnemia(Risk):
     def setup(self, builder):
         super().setup(builder)
 
-        self.anemia_thresholds = builder.lookup.build_table(
-            get_anemia_thresholds(),
-            key_columns=[],
-            parameter_columns=[('age', 'age_group_start', 'age_group_end')],
-            value_columns=['severe_threshold', 'moderate_threshold', 'mild_threshold']
-        )
+        self.anemia_thresholds = AnemiaThresholds(get_anemia_thresholds())
         self._disability_weight_data = builder.lookup.build_table(get_iron_deficiency_disability_weight(builder))
         self.disability_weight = builder.value.register_value_producer('iron_deficiency.disability_weight',
                                                                        source=self.compute_disability_weight)
@@ -38,73 +40,125 @@ class IronDeficiencyAnemia(Risk):
 
         self.pop_view = builder.population.get_view(['alive', 'age'])
 
-        self.data = {}
+        # Anemia severity codes are cached per simulant and shared by the
+        # disability weight and the observer.  Each code is keyed on the clock
+        # time and the simulant's age when it was computed.
+        self._severity = SimulantArray(dtype=np.int8)
+        self._severity_time = SimulantArray(dtype=np.int64, fill_value=NAT)
+        self._severity_age = SimulantArray(dtype=np.float64, fill_value=np.nan)
+
         self.observer_config = builder.configuration['metrics']['anemia_observer']
+        self.sampling_schedule = SamplingSchedule(builder, self.observer_config.sample_date)
+
+        if self.observer_config.by_treatment_phase:
+            self.treatment_algorithm = builder.components.get_component('sqlns_treatment_algorithm')
+            self.treatment_ramp = builder.configuration.sqlns[f'effect_on_{self.risk.name}'].ramp
+            strata = [f'0_to_5_in_sqlns_{phase}' for phase in TREATMENT_PHASES]
+        else:
+            strata = ['0_to_5']
+        self.sample_counts = SampleCounts(self.sampling_schedule.years, strata, ANEMIA_SEVERITIES)
+
         self.clock = builder.time.clock()
         builder.value.register_value_modifier('metrics', self.metrics)
         builder.event.register_listener('collect_metrics', self.on_collect_metrics)
 
+    def on_initialize_simulants(self, pop_data):
+        super().on_initialize_simulants(pop_data)
+        self._severity_time.set(pop_data.index, NAT)
+
     def compute_disability_weight(self, index):
-        disability_weight = pd.Series(0, index=index)
+        pop = self.pop_view.get(index)
+        severity = self._get_anemia_severity(index, pop.age.values)
 
         disability_weight_data = self._disability_weight_data(index)
-        mild, moderate, severe = self.split_for_anemia(index)
-
-        disability_weight.loc[mild] = disability_weight_data.loc[mild, 'mild']
-        disability_weight.loc[moderate] = disability_weight_data.loc[moderate, 'moderate']
-        disability_weight.loc[severe] = disability_weight_data.loc[severe, 'severe']
-
-        return disability_weight * (self.pop_view.get(index).alive == 'alive')
-
-    def split_for_anemia(self, index):
-        anemia = self.anemia_thresholds(index)
-        hemoglobin = self.exposure(index)
-
-        mild = (anemia.moderate_threshold <= hemoglobin) & (hemoglobin < anemia.mild_threshold)
-        moderate = (anemia.severe_threshold <= hemoglobin) & (hemoglobin < anemia.moderate_threshold)
-        severe = hemoglobin < anemia.severe_threshold
-
-        return mild, moderate, severe
+        weights = np.column_stack([np.zeros(len(index)),
+                                   disability_weight_data[ANEMIA_SEVERITIES[1:]].values])
+        disability_weight = weights[np.arange(len(index)), severity]
+
+        alive = pop.alive.values == 'alive'
+        return pd.Series(disability_weight * alive, index=index)
+
+    def get_anemia_severity(self, index: pd.Index) -> np.ndarray:
+        """Returns the anemia severity of the simulants in ``index`` as int8
+        codes into ``ANEMIA_SEVERITIES`` (0: unexposed, 1: mild, 2: moderate,
+        3: severe).
+
+        Severities are only recomputed for simulants whose cached value was
+        computed at a different clock time or age (ages are updated during
+        the time step, before the clock moves on), or who have been created
+        since.  This doesn't depend on when in the time step it's called.
+        """
+        return self._get_anemia_severity(index, self.pop_view.get(index).age.values)
+
+    def _get_anemia_severity(self, index: pd.Index, age: np.ndarray) -> np.ndarray:
+        time = self.clock().value
+        is_stale = (self._severity_time.get(index) != time) | (self._severity_age.get(index) != age)
+        if is_stale.any():
+            stale = index[is_stale]
+            hemoglobin = self.exposure(stale).values
+            self._severity.set(stale, self.anemia_thresholds.get_severity(age[is_stale], hemoglobin))
+            self._severity_time.set(stale, time)
+            self._severity_age.set(stale, age[is_stale])
+
+        return self._severity.get(index)
 
     def on_collect_metrics(self, event):
         """Records counts of risk exposed by category."""
+        if not self.should_sample(self.clock()):
+            return
+
         pop = self.pop_view.get(event.index, query='alive == "alive"')
+        key = self._get_anemia_severity(pop.index, pop.age.values).astype(np.int64)
+        if self.observer_config.by_treatment_phase:
+            phase, _ = self.treatment_algorithm.get_treatment_state(pop.index, self.treatment_ramp)
+            key += phase.astype(np.int64) * len(ANEMIA_SEVERITIES)
 
-        if self.should_sample(event.time):
-            sample = self.generate_sampling_frame()
-            mild, moderate, severe = self.split_for_anemia(pop.index)
-            sample.loc['0_to_5', 'mild'] = len(pop.loc[mild])
-            sample.loc['0_to_5', 'moderate'] = len(pop.loc[moderate])
-            sample.loc['0_to_5', 'severe'] = len(pop.loc[severe])
-            sample.loc['0_to_5', 'unexposed'] = len(pop) - (len(pop.loc[mild])
-                                                            + len(pop.loc[moderate])
-                                                            + len(pop.loc[severe]))
-
-            self.data[self.clock().year] = sample
-
-    def should_sample(self, event_time: pd.Timestamp) -> bool:
-        """Returns true if we should sample on this time step."""
-        sample_date = pd.Timestamp(event_time.year,
-                                   self.observer_config.sample_date.month,
-                                   self.observer_config.sample_date.day)
-        return self.clock() <= sample_date < event_time
-
-    def generate_sampling_frame(self) -> pd.DataFrame:
-        """Generates an empty sampling data frame."""
-        sample = pd.DataFrame({'unexposed': 0, 'mild': 0, 'moderate': 0, 'severe': 0}, index=['0_to_5'])
-        return sample
+        counts = np.bincount(key, minlength=len(self.sample_counts.strata) * len(ANEMIA_SEVERITIES))
+        self.sample_counts.add(self.clock().year, counts)
+
+    def should_sample(self, clock: pd.Timestamp) -> bool:
+        """Returns true if the time step starting at ``clock`` is a sampling step."""
+        return self.sampling_schedule.should_sample(clock)
 
     def metrics(self, index, metrics):
-        for year, sample in self.data.items():
-            for category in sample.columns:
-                label = f'anemia_{category}_in_{year}_among_0_to_5'
-                metrics[label] = sample.loc['0_to_5', category]
+        metrics.update(self.sample_counts.to_dict('anemia_{category}_in_{year}_among_{stratum}'))
         return metrics
 
     def __repr__(self):
         return f"CategoricalRiskObserver({self.risk})"
 
 
+class AnemiaThresholds:
+    """Age-specific anemia thresholds as a precomputed breakpoint table.
+
+    The thresholds are a handful of constant rows, so rather than going
+    through an interpolated lookup table we find each simulant's age group
+    with a binary search over the age group starts.  Age groups are
+    inclusive on the left and the first and last groups are extended to
+    cover all ages, matching an order 0 lookup table with extrapolation.
+    """
+
+    def __init__(self, thresholds: pd.DataFrame):
+        thresholds = thresholds.sort_values('age_group_start')
+        self.age_group_start = thresholds['age_group_start'].values
+        self.mild = thresholds['mild_threshold'].values
+        self.moderate = thresholds['moderate_threshold'].values
+        self.severe = thresholds['severe_threshold'].values
+
+    def get_age_group(self, age: np.ndarray) -> np.ndarray:
+        age_group = np.searchsorted(self.age_group_start, age, side='right') - 1
+        return np.clip(age_group, 0, len(self.age_group_start) - 1)
+
+    def get_severity(self, age: np.ndarray, hemoglobin: np.ndarray) -> np.ndarray:
+        """Returns int8 codes into ``ANEMIA_SEVERITIES`` for the given ages and hemoglobin levels."""
+        age_group = self.get_age_group(age)
+        # Thresholds are ordered severe < moderate < mild, so the number of
+        # thresholds above the hemoglobin level is the severity code.
+        severity = np.add(hemoglobin < self.mild[age_group], hemoglobin < self.moderate[age_group], dtype=np.int8)
+        severity += hemoglobin < self.severe[age_group]
+        return severity
+
+
 def get_anemia_thresholds():
     """Thresholds from 'Severity definitions used to calculate GBD 2016 anemia
     envelope' table, pg. 763 in supplementary appendix 1 to GBD 2017 found here
@@ -1,8 +1,13 @@
 import pathlib
 
+import numpy as np
 import pandas as pd
 from vivarium_public_health.utilities import EntityString
 from vivarium_public_health.metrics import Disability
+from vivarium_public_health.metrics.utilities import get_age_bins, get_output_template
+
+from .sq_lns_intervention import NAT, TREATMENT_PHASES
+from .utilities import PipelineBatch, SampleCounts, SamplingSchedule, SimulantArray
 
 
 class DisabilityObserver(Disability):
@@ -31,6 +36,11 @@ class RiskObserver:
             sample_date:
                 month: 12
                 day: 31
+
+    Counts can also be split by SQ-LNS treatment phase (untreated, ramp up,
+    full treatment, ramp down and post treatment) with ``by_treatment_phase``.
+    Phases are taken from the treatment algorithm using the ramp of the SQ-LNS
+    effect on the risk.
     """
     configuration_defaults = {
         'metrics': {
@@ -39,7 +49,8 @@ class RiskObserver:
                 'sample_date': {
                     'month': 7,
                     'day': 1
-                }
+                },
+                'by_treatment_phase': False,
             }
         }
     }
@@ -62,10 +73,18 @@ class RiskObserver:
         return f'categorical_risk_observer.{self.risk}'
 
     def setup(self, builder):
-        self.data = {}
         self.config = builder.configuration[f'metrics'][f'{self.risk.name}_observer']
         self.clock = builder.time.clock()
         self.categories = self.config.categories
+        self.sampling_schedule = SamplingSchedule(builder, self.config.sample_date)
+
+        if self.config.by_treatment_phase:
+            self.treatment_algorithm = builder.components.get_component('sqlns_treatment_algorithm')
+            self.treatment_ramp = builder.configuration.sqlns[f'effect_on_{self.risk.name}'].ramp
+            strata = [f'0_to_5_in_sqlns_{phase}' for phase in TREATMENT_PHASES]
+        else:
+            strata = ['0_to_5']
+        self.sample_counts = SampleCounts(self.sampling_schedule.years, strata, self.categories)
 
         self.population_view = builder.population.get_view(['alive', 'age'], query='alive == "alive"')
 
@@ -76,30 +95,27 @@ class RiskObserver:
 
     def on_collect_metrics(self, event):
         """Records counts of risk exposed by category."""
-        pop = self.population_view.get(event.index)
-
-        if self.should_sample(event.time):
-            sample = self.generate_sampling_frame()
-            exposure = self.exposure(pop.index)
-            sample.loc['0_to_5'] = exposure.value_counts()
+        if not self.should_sample(self.clock()):
+            return
 
-            self.data[self.clock().year] = sample
+        pop = self.population_view.get(event.index)
+        exposure = self.exposure(pop.index)
+        key = pd.Categorical(exposure, categories=self.categories).codes.astype(np.int64)
+        counted = key >= 0
+        if self.config.by_treatment_phase:
+            phase, _ = self.treatment_algorithm.get_treatment_state(pop.index, self.treatment_ramp)
+            key += phase.astype(np.int64) * len(self.categories)
 
-    def should_sample(self, event_time: pd.Timestamp) -> bool:
-        """Returns true if we should sample on this time step."""
-        sample_date = pd.Timestamp(event_time.year, self.config.sample_date.month, self.config.sample_date.day)
-        return self.clock() <= sample_date < event_time
+        counts = np.bincount(key[counted], minlength=len(self.sample_counts.strata) * len(self.categories))
+        self.sample_counts.add(self.clock().year, counts)
 
-    def generate_sampling_frame(self) -> pd.DataFrame:
-        """Generates an empty sampling data frame."""
-        sample = pd.DataFrame({f'{cat}': 0 for cat in self.categories}, index=['0_to_5'])
-        return sample
+    def should_sample(self, clock: pd.Timestamp) -> bool:
+        """Returns true if the time step starting at ``clock`` is a sampling step."""
+        return self.sampling_schedule.should_sample(clock)
 
     def metrics(self, index, metrics):
-        for year, sample in self.data.items():
-            for category in sample.columns:
-                label = f'{self.risk.name}_{category}_exposed_in_{year}_among_0_to_5'
-                metrics[label] = sample.loc['0_to_5', category]
+        label = f'{self.risk.name}_{{category}}_exposed_in_{{year}}_among_{{stratum}}'
+        metrics.update(self.sample_counts.to_dict(label))
         return metrics
 
     def __repr__(self):
@@ -113,6 +129,7 @@ class SampleHistoryObserver:
             'sample_history': {
                 'sample_proportion': 0.01,
                 'path': '~/sample_history.hdf',
+                'flush_every': 30,  # Number of recorded time steps to buffer in memory.
             },
         },
     }
@@ -122,7 +139,6 @@ class SampleHistoryObserver:
         return "sample_history_observer"
 
     def __init__(self):
-        self.history_snapshots = []
         self.sample_index = pd.Index([])
 
     def setup(self, builder):
@@ -131,6 +147,9 @@ class SampleHistoryObserver:
         self.path = pathlib.Path(config['path']).resolve()
         if self.path.suffix != '.hdf':
             raise ValueError("metrics: sample_history: path must specify a path to an HDF file.")
+        self.writer = SampleHistoryWriter(self.path, 'sample_histories', config['flush_every'],
+                                          start_time=pd.Timestamp(**builder.configuration['time']['start'].to_dict()),
+                                          step_size=builder.time.step_size()())
 
         self.clock = builder.time.clock()
         self.randomness = builder.randomness.get_stream('sample_index')
@@ -152,6 +171,10 @@ class SampleHistoryObserver:
             'protein_energy_malnutrition_disability_weight': builder.value.get_value('protein_energy_malnutrition.disability_weight'),
             'disability_weight': builder.value.get_value('disability_weight')
         }
+        # we want continuous exposures
+        self.pipeline_batch = PipelineBatch(self.pipelines,
+                                            skip_post_processor=[name for name in self.pipelines
+                                                                 if name.endswith('_exposure')])
 
         builder.population.initializes_simulants(self.get_sample_index)
         builder.event.register_listener('collect_metrics', self.record)
@@ -163,57 +186,275 @@ class SampleHistoryObserver:
 
     def record(self, event):
         pop = self.population_view.get(self.sample_index)
-        pipeline_results = []
-        for name, pipeline in self.pipelines.items():
-            if name.endswith('_exposure'):
-                skip_post_processor = True  # we want continuous exposures
-            else:
-                skip_post_processor = False
+        # Using pop.index due to untracked individuals
+        values, sources = self.pipeline_batch.evaluate(pop.index)
 
-            # Using pop.index due to untracked individuals
-            values = pipeline(pop.index, skip_post_processor=skip_post_processor)
-            values = values.rename(name)
-            pipeline_results.append(values)
+        pipeline_results = []
+        for name in self.pipelines:
+            pipeline_results.append(values[name].astype(float).rename(name))
 
             # some pipelines sources aren't really a 'baseline'
             if not name.endswith('disability_weight') and not name.endswith('_incidence_rate'):
-                raw_values = pipeline.source(pop.index)
-                raw_values = raw_values.rename(f'{name}_baseline')
-                pipeline_results.append(raw_values)
+                pipeline_results.append(sources[name].astype(float).rename(f'{name}_baseline'))
 
         record = pd.concat(pipeline_results + [pop], axis=1)
         record['time'] = self.clock()
         record.index.rename("simulant", inplace=True)
         record.set_index('time', append=True, inplace=True)
 
-        self.history_snapshots.append(record)
+        self.writer.append(record)
 
     def dump_history(self, event):
-        sample_history = pd.concat(self.history_snapshots, axis=0)
-        sample_history.to_hdf(self.path, key='sample_histories')
+        self.writer.flush()
+
+
+class SampleHistoryWriter:
+    """Streams sample history records to an appendable HDF table.
+
+    Records are buffered in memory and appended to the table every
+    ``flush_every`` records, so memory use is bounded by the buffer rather
+    than the length of the run, and an interrupted run keeps everything
+    recorded up to the last flush.  Any existing table under ``key`` is
+    replaced on the first flush.
+
+    Records are stored in a compact schema:
+
+    - the index is (``simulant``, ``step``), both int32, where ``step`` is
+      the number of time steps since the start of the simulation;
+    - ``alive`` and ``sex`` are categoricals with fixed categories;
+    - datetime columns (``exit_time``, ``sqlns_treatment_start``,
+      ``sqlns_treatment_end``) are int64 nanosecond offsets from the start
+      of the simulation, with the int64 minimum for NaT.  They aren't
+      stored as steps because they needn't fall on a step boundary (e.g.
+      treatment ends 365.25 days after it starts);
+    - every other column (pipeline values and age) is float32.
+
+    The simulation start, step size and the names of the datetime columns
+    are stored as attributes of the table.  Use :func:`read_sample_history`
+    to get back the (``simulant``, ``time``) indexed layout.
+    """
+
+    compression = {'complib': 'zlib', 'complevel': 5}
+    categories = {
+        'alive': ['alive', 'dead', 'untracked'],
+        'sex': ['Male', 'Female'],
+    }
+
+    def __init__(self, path: pathlib.Path, key: str, flush_every: int,
+                 start_time: pd.Timestamp, step_size: pd.Timedelta):
+        self.path = path
+        self.key = key
+        self.flush_every = flush_every
+        self.start_time = start_time
+        self.step_size = step_size
+        self._buffer = []
+        self._datetime_columns = []
+        self._started = False
+
+    def append(self, record: pd.DataFrame):
+        self._buffer.append(self.to_compact(record))
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        records = pd.concat(self._buffer, axis=0)
+        self._buffer = []
+
+        with pd.HDFStore(str(self.path), mode='a', **self.compression) as store:
+            if not self._started and self.key in store:
+                store.remove(self.key)
+            store.append(self.key, records, format='table')
+            attrs = store.get_storer(self.key).attrs
+            attrs.start_time = self.start_time.value
+            attrs.step_size = self.step_size.value
+            attrs.datetime_columns = self._datetime_columns
+        self._started = True
+
+    def to_compact(self, record: pd.DataFrame) -> pd.DataFrame:
+        index = pd.MultiIndex.from_arrays(
+            [record.index.get_level_values('simulant').values.astype(np.int32),
+             self.to_step(record.index.get_level_values('time'))],
+            names=['simulant', 'step'])
+
+        columns = {}
+        for column, values in record.items():
+            if column in self.categories:
+                columns[column] = pd.Categorical(values.values, categories=self.categories[column])
+            elif pd.api.types.is_datetime64_any_dtype(values):
+                columns[column] = self.to_offset(values)
+                if column not in self._datetime_columns:
+                    self._datetime_columns.append(column)
+            else:
+                columns[column] = values.values.astype(np.float32)
+        return pd.DataFrame(columns, index=index, columns=record.columns)
+
+    def to_offset(self, times) -> np.ndarray:
+        times = np.asarray(times, dtype='datetime64[ns]').view(np.int64)
+        return np.where(times == NAT, NAT, times - self.start_time.value)
+
+    def to_step(self, times) -> np.ndarray:
+        return np.round(self.to_offset(times) / self.step_size.value).astype(np.int32)
+
+
+def read_sample_history(path, key: str = 'sample_histories') -> pd.DataFrame:
+    """Reads a sample history written by :class:`SampleHistoryWriter` back into
+    the layout the analysis notebooks expect: indexed by (``simulant``,
+    ``time``) with float64 values, string ``alive`` and ``sex`` columns and
+    datetime columns.  Histories written before the compact schema are
+    returned as is.
+    """
+    with pd.HDFStore(str(path), mode='r') as store:
+        history = store.select(key)
+        attrs = store.get_storer(key).attrs
+        if 'step' not in history.index.names:
+            return history
+        start_time, step_size = attrs.start_time, attrs.step_size
+        datetime_columns = list(attrs.datetime_columns)
+
+    def to_time(offsets):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        times = np.where(offsets == NAT, NAT, start_time + offsets)
+        return pd.DatetimeIndex(times.view('datetime64[ns]'))
+
+    columns = {}
+    for column, values in history.items():
+        if column in datetime_columns:
+            columns[column] = to_time(values.values)
+        elif pd.api.types.is_categorical_dtype(values):
+            columns[column] = values.values.astype(object)
+        else:
+            columns[column] = values.values.astype(np.float64)
+    index = pd.MultiIndex.from_arrays(
+        [history.index.get_level_values('simulant').values.astype(np.int64),
+         to_time(history.index.get_level_values('step').values.astype(np.int64) * step_size)],
+        names=['simulant', 'time'])
+    return pd.DataFrame(columns, index=index, columns=history.columns)
 
 
 class SQLNSObserver:
-    """Observer for total days treated with SQLNS."""
+    """Observer for total days treated with SQLNS.
+
+    Treated days are accumulated as simulants are enrolled in treatment.
+    Enrolled simulants are tracked until their treatment ends, and if one
+    exits the simulation first the days it would have gone on being treated
+    are taken back off, so collecting metrics doesn't rescan the population.
+
+    Treated days can also be split by calendar year and by age group, in
+    which case only the split treated days are reported:
+
+    .. code-block:: yaml
+
+        configuration:
+            metrics:
+                sqlns_observer:
+                    by_year: True
+                    by_age: True
+    """
+
+    configuration_defaults = {
+        'metrics': {
+            'sqlns_observer': {
+                'by_year': False,
+                'by_age': False,
+            }
+        }
+    }
 
     @property
     def name(self):
         return 'sqlns_observer'
 
     def setup(self, builder):
-        self.population_view = builder.population.get_view(['tracked', 'exit_time',
-                                                            'sqlns_treatment_start', 'sqlns_treatment_end'])
+        self.config = builder.configuration['metrics']['sqlns_observer']
+        self.stratified = self.config.by_year or self.config.by_age
+        self.clock = builder.time.clock()
+        self.treatment_algorithm = builder.components.get_component('sqlns_treatment_algorithm')
+        self.population_view = builder.population.get_view(['age', 'exit_time'])
+
+        self.treated_days = 0.
+        # Enrolled simulants whose treatment hasn't ended or been cut short yet.
+        self._active = pd.Index([], dtype=np.int64)
+
+        if self.stratified:
+            age_bins = get_age_bins(builder)
+            self.age_groups = list(age_bins.age_group_name)
+            self._age_group_bounds = (age_bins[['age_group_start', 'age_group_end']].values
+                                      * pd.Timedelta(days=365.25).value).astype(np.int64)
+
+            # Treatment can run on past the end of the simulation and is
+            # counted in full, so the years cover the longest possible course.
+            start_year = builder.configuration.time.start.year
+            end_year = (pd.Timestamp(**builder.configuration.time.end.to_dict())
+                        + self.treatment_algorithm.duration).year
+            self.years = list(range(start_year, end_year + 1))
+            self._year_bounds = np.array([pd.Timestamp(year=year, month=1, day=1).value
+                                          for year in range(start_year, end_year + 2)], dtype=np.int64)
+
+            self._birth_time = SimulantArray(dtype=np.int64)
+            self._stratified_days = np.zeros((len(self.years), len(self.age_groups)))
+
         builder.value.register_value_modifier('metrics', self.metrics)
+        # After the treatment algorithm has enrolled simulants.
+        builder.event.register_listener('time_step', self.on_time_step, priority=6)
+        builder.event.register_listener('time_step__cleanup', self.on_time_step_cleanup)
+
+    def on_time_step(self, event):
+        enrolled = self.treatment_algorithm.enrolled
+        if enrolled.empty:
+            return
+        start, end = self.treatment_algorithm.get_treatment_times(enrolled)
+        self.treated_days += (end - start).sum() / pd.Timedelta(days=1).value
+
+        if self.stratified:
+            age = self.population_view.get(enrolled)['age'].values
+            birth_time = self.clock().value - (age * pd.Timedelta(days=365.25).value).astype(np.int64)
+            self._birth_time.set(enrolled, birth_time)
+            self._stratified_days += self.split_treated_days(start, end, birth_time)
+
+        self._active = self._active.append(enrolled)
+
+    def on_time_step_cleanup(self, event):
+        if self._active.empty:
+            return
+        start, end = self.treatment_algorithm.get_treatment_times(self._active)
+        exit_time = self.population_view.get(self._active)['exit_time'].values.astype(np.int64)
+
+        exited = (exit_time != NAT) & (exit_time < end)
+        if exited.any():
+            self.treated_days -= (end[exited] - exit_time[exited]).sum() / pd.Timedelta(days=1).value
+            if self.stratified:
+                birth_time = self._birth_time.get(self._active[exited])
+                self._stratified_days -= self.split_treated_days(exit_time[exited], end[exited], birth_time)
+
+        finished = exited | (end <= event.time.value)
+        self._active = self._active[~finished]
+
+    def split_treated_days(self, start: np.ndarray, end: np.ndarray, birth_time: np.ndarray) -> np.ndarray:
+        """Splits the treatment intervals ``[start, end)`` across calendar
+        years and age groups, returning the days treated in each as a
+        (year, age group) array."""
+        lower = np.maximum(start[:, None, None], self._year_bounds[None, :-1, None])
+        lower = np.maximum(lower, (birth_time[:, None] + self._age_group_bounds[:, 0])[:, None, :])
+        upper = np.minimum(end[:, None, None], self._year_bounds[None, 1:, None])
+        upper = np.minimum(upper, (birth_time[:, None] + self._age_group_bounds[:, 1])[:, None, :])
+        return np.clip(upper - lower, 0, None).sum(axis=0) / pd.Timedelta(days=1).value
 
     def metrics(self, index, metrics):
-        pop = self.population_view.get(index)
-        treated = pop.loc[~pop['sqlns_treatment_start'].isnull()]
-
-        treatment_end = treated['sqlns_treatment_end'].copy()
-        died_before_treatment_end = treated['exit_time'] < treatment_end
-        treatment_end.loc[died_before_treatment_end] = treated.loc[died_before_treatment_end, 'exit_time']
-
-        treatment_days = (treatment_end - treated['sqlns_treatment_start']) / pd.Timedelta(days=1)
-
-        metrics['sqlns_treated_days'] = treatment_days.sum()
+        # Stratified runs only report the strata, so the total isn't counted again alongside them.
+        if not self.stratified:
+            metrics['sqlns_treated_days'] = self.treated_days
+        else:
+            treated_days = pd.DataFrame(self._stratified_days, index=self.years, columns=self.age_groups)
+            if not self.config.by_year:
+                treated_days = treated_days.sum().to_frame('all').T
+            if not self.config.by_age:
+                treated_days = treated_days.sum(axis=1).to_frame('all')
+
+            template = get_output_template(by_age=self.config.by_age, by_sex=False, by_year=self.config.by_year)
+            for year, days in treated_days.iterrows():
+                for age_group, value in days.items():
+                    key = template.substitute(measure='sqlns_treated_days', year=year, age_group=age_group)
+                    metrics[key] = value
         return metrics
@@ -1,9 +1,17 @@
+from collections import defaultdict
+
 import numpy as np
 import pandas as pd
 from scipy import stats
 from vivarium.framework.event import Event
 from vivarium_public_health.utilities import TargetString
 
+from .utilities import SimulantArray
+
+UNTREATED, RAMP_UP, FULL_TREATMENT, RAMP_DOWN, POST_TREATMENT = range(5)
+TREATMENT_PHASES = ['untreated', 'ramp_up', 'full_treatment', 'ramp_down', 'post_treatment']
+NAT = np.iinfo(np.int64).min
+
 
 class SQLNSTreatmentAlgorithm:
 
@@ -35,9 +43,26 @@ class SQLNSTreatmentAlgorithm:
         self.coverage = config['program_coverage']
 
         self.clock = builder.time.clock()
+        self.step_size = builder.time.step_size()
+        self.sim_start = pd.Timestamp(**builder.configuration['time']['start'].to_dict())
 
         self.rand = builder.randomness.get_stream("sqlns_coverage")
 
+        # Simulants bucketed by the time step in which they're expected to
+        # reach the treatment start age, so continuous enrollment only looks
+        # at the handful of simulants due on each step.
+        self._enrollment_queue = defaultdict(list)
+        self._oldest_enrollment_step = -1
+
+        # Treatment times mirrored from the state table as int64 nanoseconds
+        # so treatment phases can be classified without a population view.
+        self._treatment_start = SimulantArray(dtype=np.int64, fill_value=NAT)
+        self._treatment_end = SimulantArray(dtype=np.int64, fill_value=NAT)
+        self._treatment_state = {}
+        self._treatment_state_time = None
+        # Simulants enrolled in treatment on the current time step.
+        self.enrolled = pd.Index([], dtype=np.int64)
+
         created_columns = ['sqlns_treatment_start', 'sqlns_treatment_end']
         required_columns = ['age']
 
@@ -55,14 +80,36 @@ class SQLNSTreatmentAlgorithm:
         pop = pd.DataFrame({'sqlns_treatment_start': pd.NaT, 'sqlns_treatment_end': pd.NaT},
                            index=pop_data.index)
         self.pop_view.update(pop)
+        self._treatment_start.set(pop_data.index, NAT)
+        self._treatment_end.set(pop_data.index, NAT)
+        self._treatment_state = {}
+
+        self.schedule_enrollment(self.pop_view.get(pop_data.index)['age'], pop_data.creation_time)
 
     def on_time_step(self, event):
-        pop = self.pop_view.get(event.index, query="alive == 'alive'")
+        self.enrolled = pd.Index([], dtype=np.int64)
+        step = self.get_step_number(self.clock())
+        if self.clock() < self.start_date <= event.time:
+            pop = self.pop_view.get(event.index, query="alive == 'alive'")
+        elif self.start_date <= self.clock():
+            pop = self.pop_view.get(self.get_enrollment_candidates(step), query="alive == 'alive'")
+        else:
+            pop = None
+        self._drop_enrollment_step(step - 1)
+
+        if pop is None:
+            return
         treated_idx = self.get_treated_idx(pop, event)
+        if treated_idx.empty:
+            return
 
-        pop.loc[treated_idx, 'sqlns_treatment_start'] = event.time
-        pop.loc[treated_idx, 'sqlns_treatment_end'] = event.time + self.duration
-        self.pop_view.update(pop)
+        treated = pd.DataFrame({'sqlns_treatment_start': event.time,
+                                'sqlns_treatment_end': event.time + self.duration}, index=treated_idx)
+        self.pop_view.update(treated)
+        self._treatment_start.set(treated_idx, event.time.value)
+        self._treatment_end.set(treated_idx, (event.time + self.duration).value)
+        self._treatment_state = {}
+        self.enrolled = treated_idx
 
     def get_treated_idx(self, pop: pd.DataFrame, event: Event):
         pop_age_at_event = pop.age + (event.step_size / pd.Timedelta(days=365.25))
@@ -82,6 +129,72 @@ class SQLNSTreatmentAlgorithm:
 
         return treated_idx
 
+    def get_step_number(self, time: pd.Timestamp) -> int:
+        return (time - self.sim_start) // self.step_size()
+
+    def schedule_enrollment(self, age: pd.Series, creation_time: pd.Timestamp):
+        """Queues simulants younger than the treatment start age under the
+        time step in which they'll cross it.
+
+        Simulants enroll on the step whose clock time is before their
+        birthday at the treatment start age and whose event time is at or
+        after it.  Ages in the state table accumulate a step at a time, so the
+        estimate can be off by a step either way.  Candidates are therefore
+        drawn from the neighbouring steps too and the exact age test is
+        applied when they're pulled from the queue.
+        """
+        age = age[age < self.treatment_age['start']]
+        if age.empty:
+            return
+        step_days = self.step_size() / pd.Timedelta(days=1)
+        days_to_start = ((creation_time - self.sim_start) / pd.Timedelta(days=1)
+                         + (self.treatment_age['start'] - age.values) * 365.25)
+        steps = np.ceil(days_to_start / step_days).astype(np.int64) - 1
+        steps = np.maximum(steps, self._oldest_enrollment_step)
+
+        order = np.argsort(steps, kind='mergesort')
+        steps, simulants = steps[order], age.index.values[order]
+        boundaries = np.flatnonzero(np.diff(steps)) + 1
+        for step, due in zip(steps[np.r_[0, boundaries]], np.split(simulants, boundaries)):
+            self._enrollment_queue[step].append(due)
+
+    def get_enrollment_candidates(self, step: int) -> pd.Index:
+        """Simulants that may reach the treatment start age during ``step``."""
+        due = [simulants for s in range(step - 1, step + 2) for simulants in self._enrollment_queue.get(s, [])]
+        return pd.Index(np.concatenate(due)) if due else pd.Index([], dtype=np.int64)
+
+    def _drop_enrollment_step(self, step: int):
+        # A simulant queued under a step can't be due after the following one.
+        while self._oldest_enrollment_step <= step:
+            self._enrollment_queue.pop(self._oldest_enrollment_step, None)
+            self._oldest_enrollment_step += 1
+
+    def get_treatment_times(self, index: pd.Index):
+        """Returns the treatment start and end times of the simulants in
+        ``index`` as int64 nanoseconds, with ``NAT`` for untreated simulants."""
+        return self._treatment_start.get(index), self._treatment_end.get(index)
+
+    def get_treatment_state(self, index: pd.Index, ramp: float):
+        """Returns the treatment phase codes and ramp scales of the simulants
+        in ``index`` for an effect with a ramp of ``ramp`` days.
+
+        Phases are classified for the whole population at most once per clock
+        tick and ramp length and shared by every effect that asks for them.
+        The cache is dropped when the clock advances, when simulants are added
+        and when new simulants are enrolled in treatment.
+        """
+        time = self.clock()
+        if time != self._treatment_state_time:
+            self._treatment_state = {}
+            self._treatment_state_time = time
+        if ramp not in self._treatment_state:
+            self._treatment_state[ramp] = get_treatment_phase_and_scale(self._treatment_start.values,
+                                                                        self._treatment_end.values,
+                                                                        time.value, ramp)
+        phase, scale = self._treatment_state[ramp]
+        positions = np.asarray(index, dtype=np.int64)
+        return phase[positions], scale[positions]
+
 
 class SQLNSEffect:
 
@@ -107,16 +220,15 @@ class SQLNSEffect:
 
     def setup(self, builder):
         self.config = builder.configuration.sqlns[f'effect_on_{self.target.name}']
-        self.clock = builder.time.clock()
 
-        self._effect_size = pd.Series()
+        self._effect_size = SimulantArray(dtype=np.float64)
 
         self.randomness = builder.randomness.get_stream(self.name)
 
         builder.value.register_value_modifier(f'{self.target.name}.{self.target.measure}', self.adjust_exposure)
 
         builder.population.initializes_simulants(self.on_initialize_simulants)
-        self.pop_view = builder.population.get_view(['sqlns_treatment_start', 'sqlns_treatment_end'])
+        self.treatment_algorithm = builder.components.get_component('sqlns_treatment_algorithm')
 
     def on_initialize_simulants(self, pop_data):
         rs = np.random.RandomState(seed=self.randomness.get_seed())
@@ -133,80 +245,91 @@ class SQLNSEffect:
         else:
             effect_size = individual_mean
 
-        self._effect_size = self._effect_size.append(pd.Series(effect_size, index=pop_data.index))
+        self._effect_size.set(pop_data.index, effect_size)
 
     def adjust_exposure(self, index, exposure):
-        effect_size = pd.Series(0, index=index)
-        untreated, ramp_up, full_treatment, ramp_down, post_treatment = self.get_treatment_groups(index)
-
-        effect_size.loc[untreated] = 0
-        effect_size.loc[ramp_up] = self.ramp_efficacy(ramp_up)
-        effect_size.loc[full_treatment] = self._effect_size.loc[full_treatment]
+        phase, scale = self.treatment_algorithm.get_treatment_state(index, self.config.ramp)
         if self.config.permanent:
-            effect_size.loc[ramp_down] = self._effect_size[ramp_down]
-            effect_size.loc[post_treatment] = self._effect_size[post_treatment]
-        else:
-            effect_size.loc[ramp_down] = self.ramp_efficacy(ramp_down, invert=True)
-            effect_size.loc[post_treatment] = 0
-
-        return exposure + effect_size
-
-    def get_treatment_groups(self, index):
-        ramp_time = pd.Timedelta(days=self.config.ramp)
-
-        pop = self.pop_view.get(index)
-        untreated = pop.loc[(pop['sqlns_treatment_start'].isnull())
-                            | (pop['sqlns_treatment_start'] <= self.clock())].index
-        ramp_up = pop.loc[(pop['sqlns_treatment_start'] < self.clock())
-                          & (self.clock() < pop['sqlns_treatment_start'] + ramp_time)].index
-        full_treatment = pop.loc[(pop['sqlns_treatment_start'] + ramp_time <= self.clock())
-                                 & (self.clock() <= pop['sqlns_treatment_end'])].index
-        ramp_down = pop.loc[(pop['sqlns_treatment_end'] < self.clock())
-                            & (self.clock() < pop['sqlns_treatment_end'] + ramp_time)].index
-        post_treatment = pop.loc[pop['sqlns_treatment_end'] + ramp_time <= self.clock()].index
-
-        return untreated, ramp_up, full_treatment, ramp_down, post_treatment
-
-    def ramp_efficacy(self, index, invert=False):
-        """Logistic growth/decline of effect size.
-
-        We're using a logistic function here to give a smooth treatment ramp.
-        A logistic function has the form L/(1 - e**(-k * (t - t0))
-        Where
-        L  : function maximum
-        t0 : center of the function
-        k  : growth rate
-
-        We want the function to be 0 for times below the treatment start,
-        then to ramp up to the maximum over sum duration, stay there until
-        the treatment stops, then ramp back down over the same duration.
-        This means we effectively want to squeeze a logistic function into
-        the discontinuities between a step function.  Making a function
-        that smoothly transitions would be more math than I want to do right
-        now.  Making a function that almost smoothly transitions is pretty
-        easy and involves picking a growth rate that gets us very close
-        to 0 and the maximum effect when we transition between constant
-        effect sizes and the growth periods.
-
-        I've parameterized in terms of the inverse of the  proportion of the
-        maximum effect size, p, so that the jump between the different
-        sections of the function is equal to (1 / p) * L.
-
-        """
-        if index.empty:
-            return pd.Series()
-
-        pop = self.pop_view.get(index)
-        # 1/p is the proportion of the maximum effect.
-        # Size of the discontinuity between constant and logistic functions.
-        p = 10_000
-        growth_rate = 2 / self.config.ramp * np.log(p)
-        ramp_days = pd.Timedelta(days=self.config.ramp)
-
-        if invert:
-            ramp_position = ((pop['sqlns_treatment_end'] + ramp_days / 2) - self.clock()) / pd.Timedelta(days=1)
-        else:
-            ramp_position = (self.clock() - (pop['sqlns_treatment_start'] + ramp_days / 2)) / pd.Timedelta(days=1)
-
-        scale = 1 / (1 + np.exp(-growth_rate * ramp_position))
-        return scale * self._effect_size[index]
+            scale[phase >= RAMP_DOWN] = 1
+
+        return exposure + scale * self._effect_size.get(index)
+
+
+def to_nanoseconds(times: pd.Series) -> np.ndarray:
+    """Views a datetime column as int64 nanoseconds since the epoch (NaT is the minimum int64)."""
+    return times.values.astype('datetime64[ns]').view(np.int64)
+
+
+def get_treatment_phase_and_scale(start: np.ndarray, end: np.ndarray, time: int, ramp: float):
+    """Classifies simulants into treatment phases and computes the proportion
+    of the maximum effect each one receives at ``time``.
+
+    ``start`` and ``end`` are treatment start and end times as int64
+    nanoseconds (with NaT for untreated simulants), ``time`` is the current
+    clock in nanoseconds and ``ramp`` is the length in days of the ramp up
+    and ramp down periods.  Returns an int8 array of phase codes
+    (``UNTREATED``, ``RAMP_UP``, ``FULL_TREATMENT``, ``RAMP_DOWN``,
+    ``POST_TREATMENT``) and a float64 array with the scale of the effect size
+    for a non-permanent effect.
+
+    We're using a logistic function here to give a smooth treatment ramp.
+    A logistic function has the form L/(1 - e**(-k * (t - t0))
+    Where
+    L  : function maximum
+    t0 : center of the function
+    k  : growth rate
+
+    We want the function to be 0 for times below the treatment start,
+    then to ramp up to the maximum over sum duration, stay there until
+    the treatment stops, then ramp back down over the same duration.
+    This means we effectively want to squeeze a logistic function into
+    the discontinuities between a step function.  Making a function
+    that smoothly transitions would be more math than I want to do right
+    now.  Making a function that almost smoothly transitions is pretty
+    easy and involves picking a growth rate that gets us very close
+    to 0 and the maximum effect when we transition between constant
+    effect sizes and the growth periods.
+
+    I've parameterized in terms of the inverse of the  proportion of the
+    maximum effect size, p, so that the jump between the different
+    sections of the function is equal to (1 / p) * L.
+
+    """
+    # Untreated simulants are pinned to the current time so they fall in no
+    # treatment phase and the arithmetic can't overflow on the NaT sentinel.
+    treated = start != NAT
+    since_start = time - np.where(treated, start, time)
+    since_end = time - np.where(treated, end, time)
+
+    # Phases are ordered in time, so once treatment has ended the simulant is
+    # ramping down or post treatment, and before that it's still ramping up or
+    # getting the full effect.  Ramp down wins if the ramp is longer than the
+    # treatment duration.
+    ramp_time = pd.Timedelta(days=ramp).value
+    ended = since_end > 0
+    phase = np.where(ended,
+                     np.add(since_end >= ramp_time, RAMP_DOWN, dtype=np.int8),
+                     np.add(since_start > 0, since_start >= ramp_time, dtype=np.int8) * treated)
+
+    scale = (phase == FULL_TREATMENT).astype(np.float64)
+    ramp_up, ramp_down = phase == RAMP_UP, phase == RAMP_DOWN
+    if ramp_time == 0:
+        # Without a ramp the full effect starts with treatment and stops with it.
+        phase[ramp_up] = FULL_TREATMENT
+        scale[ramp_up] = 1
+        return phase, scale
+
+    # 1/p is the proportion of the maximum effect.
+    # Size of the discontinuity between constant and logistic functions.
+    p = 10_000
+    growth_rate = 2 / ramp * np.log(p)
+    day = pd.Timedelta(days=1).value
+
+    scale[ramp_up] = _logistic(growth_rate, (since_start[ramp_up] - ramp_time // 2) / day)
+    scale[ramp_down] = _logistic(growth_rate, (ramp_time // 2 - since_end[ramp_down]) / day)
+
+    return phase, scale
+
+
+def _logistic(growth_rate: float, ramp_position: np.ndarray) -> np.ndarray:
+    return 1 / (1 + np.exp(-growth_rate * ramp_position))
@@ -0,0 +1,278 @@
+import numpy as np
+import pandas as pd
+from vivarium_public_health.metrics.utilities import get_output_template
+
+
+class SimulantArray:
+    """A growable, preallocated array holding one value per simulant.
+
+    Values are stored by position in a flat numpy array keyed on the
+    (integer) population index, so writes for a new cohort of simulants are
+    amortized O(1) per simulant and reads are a single vectorized gather.
+    Capacity doubles whenever an index falls outside the current buffer.
+    """
+
+    def __init__(self, dtype=np.float64, fill_value=0., initial_capacity=1024):
+        self.dtype = np.dtype(dtype)
+        self.fill_value = fill_value
+        self._values = np.full(initial_capacity, fill_value, dtype=self.dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def values(self) -> np.ndarray:
+        """A view of the stored values for every simulant seen so far."""
+        return self._values[:self._size]
+
+    def set(self, index: pd.Index, values):
+        """Stores ``values`` (an array or a scalar) for the simulants in ``index``."""
+        positions = np.asarray(index, dtype=np.int64)
+        if positions.size == 0:
+            return
+        required = int(positions.max()) + 1
+        if required > self._values.size:
+            self._grow(required)
+        self._values[positions] = values
+        self._size = max(self._size, required)
+
+    def get(self, index: pd.Index) -> np.ndarray:
+        """Gathers the stored values for the simulants in ``index``.
+
+        Simulants that have never been set read as ``fill_value``.
+        """
+        positions = np.asarray(index, dtype=np.int64)
+        if positions.size and positions.max() >= self._values.size:
+            self._grow(int(positions.max()) + 1)
+        return self._values[positions]
+
+    def _grow(self, required: int):
+        capacity = max(required, 2 * self._values.size)
+        values = np.full(capacity, self.fill_value, dtype=self.dtype)
+        values[:self._size] = self._values[:self._size]
+        self._values = values
+
+
+class SamplingSchedule:
+    """The time steps on which an observer samples the population.
+
+    An observer samples once a year, on the time step that runs from a clock
+    time at or before the sample date (in the year of the step's event time)
+    to an event time after it.  Those steps are worked out once from the
+    simulation's time bounds and step size, so checking whether a step is a
+    sampling step is a set lookup rather than a date comparison.
+    """
+
+    def __init__(self, builder, sample_date):
+        time = builder.configuration['time']
+        start = pd.Timestamp(**time['start'].to_dict())
+        end = pd.Timestamp(**time['end'].to_dict())
+        step_size = builder.time.step_size()()
+
+        clock = pd.date_range(start, end, freq=step_size).values.astype(np.int64)
+        # The simulation stops once the clock reaches the end, so no step starts there.
+        clock = clock[clock < end.value]
+        event_time = clock + step_size.value
+        sample_time = pd.to_datetime(pd.DataFrame({
+            'year': pd.DatetimeIndex(event_time).year,
+            'month': sample_date['month'],
+            'day': sample_date['day'],
+        })).values.astype(np.int64)
+
+        sampled = (clock <= sample_time) & (sample_time < event_time)
+        self._sample_clock_times = set(clock[sampled].tolist())
+        self.years = sorted(set(pd.DatetimeIndex(clock[sampled]).year))
+
+    def should_sample(self, clock: pd.Timestamp) -> bool:
+        """Returns true if the time step starting at ``clock`` is a sampling step."""
+        return clock.value in self._sample_clock_times
+
+
+class SampleCounts:
+    """Counts of sampled simulants by year, stratum and category.
+
+    Counts are accumulated in a preallocated (year, stratum, category)
+    integer array, and only turned into labelled metrics when they're
+    reported, so recording a sample costs the same however many strata
+    there are.
+    """
+
+    def __init__(self, years, strata, categories):
+        self.years = list(years)
+        self.strata = list(strata)
+        self.categories = list(categories)
+        self._year_positions = {year: i for i, year in enumerate(self.years)}
+        self.counts = np.zeros((len(self.years), len(self.strata), len(self.categories)), dtype=np.int64)
+        self.sampled = np.zeros(len(self.years), dtype=bool)
+
+    def add(self, year: int, counts: np.ndarray):
+        """Adds a (stratum, category) array of counts to ``year``."""
+        position = self._year_positions[year]
+        self.counts[position] += np.reshape(counts, self.counts.shape[1:])
+        self.sampled[position] = True
+
+    def to_dict(self, label: str) -> dict:
+        """Labels the counts of every sampled year.
+
+        ``label`` is a format string with ``year``, ``stratum`` and
+        ``category`` fields.
+        """
+        labelled = {}
+        for y in np.flatnonzero(self.sampled):
+            for s, stratum in enumerate(self.strata):
+                for c, category in enumerate(self.categories):
+                    key = label.format(year=self.years[y], stratum=stratum, category=category)
+                    labelled[key] = self.counts[y, s, c]
+        return labelled
+
+
+class StratifiedCounter:
+    """Counts simulants by age group, sex and category in a single pass.
+
+    Ages are binned with one search over the age group boundaries, sex and
+    category are reduced to integer codes, and every stratum is counted with
+    one ``np.bincount`` over the combined key.  Strata that aren't configured
+    (``by_age`` or ``by_sex`` off) collapse to a single group, the same way
+    ``get_age_sex_filter_and_iterables`` treats them.
+    """
+
+    def __init__(self, config, age_bins: pd.DataFrame, categories):
+        self.config = config
+        if config['by_age']:
+            age_bins = age_bins.sort_values('age_group_start')
+            self.age_groups = list(age_bins.age_group_name)
+            self._age_starts = age_bins.age_group_start.values
+            self._age_ends = age_bins.age_group_end.values
+        else:
+            self.age_groups = [None]
+        self.sexes = ['Male', 'Female'] if config['by_sex'] else ['Both']
+        self.categories = list(categories)
+        self.shape = (len(self.age_groups), len(self.sexes), len(self.categories))
+
+    def count(self, pop: pd.DataFrame, category_codes: np.ndarray) -> np.ndarray:
+        """Returns an (age group, sex, category) array of simulant counts.
+
+        ``pop`` needs ``age`` and ``sex`` columns for the configured strata
+        and ``category_codes`` holds each simulant's position in
+        ``categories``.  Simulants with a negative code, or outside every age
+        group, aren't counted.
+        """
+        key = np.asarray(category_codes, dtype=np.int64)
+        counted = key >= 0
+
+        if self.config['by_age']:
+            age = pop['age'].values
+            age_group = np.searchsorted(self._age_starts, age, side='right') - 1
+            counted &= age_group >= 0
+            age_group = np.maximum(age_group, 0)
+            counted &= age < self._age_ends[age_group]
+            key = key + age_group * (self.shape[1] * self.shape[2])
+
+        if self.config['by_sex']:
+            sex = pd.Categorical(pop['sex'], categories=self.sexes).codes.astype(np.int64)
+            counted &= sex >= 0
+            key = key + sex * self.shape[2]
+
+        counts = np.bincount(key[counted], minlength=int(np.prod(self.shape)))
+        return counts.reshape(self.shape)
+
+    def to_dict(self, counts: np.ndarray, measures, year: int) -> dict:
+        """Labels stratum counts with the standard output template keys.
+
+        ``measures`` holds the measure name to use for each category.
+        """
+        template = get_output_template(**self.config)
+        labelled = {}
+        for c, measure in enumerate(measures):
+            base_key = template.substitute(measure=measure, year=year)
+            for a, age_group in enumerate(self.age_groups):
+                for s, sex in enumerate(self.sexes):
+                    labelled[base_key.substitute(age_group=age_group, sex=sex)] = counts[a, s, c]
+        return labelled
+
+
+class PipelineBatch:
+    """Evaluates a set of value pipelines on one index, reusing the values
+    they share.
+
+    Each pipeline is replayed from its source, modifiers, combiner and post
+    processor.  Pipelines are evaluated in dependency order, and when the
+    source or a modifier of one pipeline is another (fully post-processed)
+    pipeline in the batch, the value already computed for it is substituted
+    instead of evaluating it again.  For example, the cause-specific
+    disability weights are reused when evaluating the total disability
+    weight.  The source value of every pipeline is returned alongside its
+    final value, so the unmodified baseline doesn't need a second
+    evaluation.
+    """
+
+    def __init__(self, pipelines: dict, skip_post_processor=()):
+        self.pipelines = pipelines
+        self.skip_post_processor = set(skip_post_processor)
+        self._order = None
+
+    def evaluate(self, index: pd.Index):
+        """Returns dictionaries of pipeline values and pipeline source values
+        for ``index``, keyed by the names the pipelines were given."""
+        if self._order is None:
+            # Modifiers are registered throughout setup, so the dependency
+            # order can only be worked out once the simulation is running.
+            self._order = self._get_evaluation_order()
+
+        evaluated = {}
+        values, sources = {}, {}
+        for name in self._order:
+            pipeline = self.pipelines[name]
+            skip_post_processor = name in self.skip_post_processor
+            values[name], sources[name] = self._evaluate(pipeline, index, evaluated, skip_post_processor)
+            if not skip_post_processor:
+                evaluated[id(pipeline)] = values[name]
+        return values, sources
+
+    def _get_evaluation_order(self):
+        names = {id(pipeline): name for name, pipeline in self.pipelines.items()}
+        dependencies = {name: {names[id(f)] for f in self._get_inputs(pipeline) if id(f) in names} - {name}
+                        for name, pipeline in self.pipelines.items()}
+
+        order = []
+        while dependencies:
+            ready = [name for name, requires in dependencies.items() if not requires - set(order)]
+            if not ready:
+                # A cycle can't happen in a working simulation, but don't loop forever.
+                ready = list(dependencies)
+            for name in ready:
+                order.append(name)
+                del dependencies[name]
+        return order
+
+    @staticmethod
+    def _get_inputs(pipeline):
+        if not _is_replayable(pipeline):
+            return []
+        return [pipeline.source] + [mutator for bucket in pipeline.mutators for mutator in bucket]
+
+    @staticmethod
+    def _evaluate(pipeline, index, evaluated, skip_post_processor):
+        if not _is_replayable(pipeline):
+            return pipeline(index, skip_post_processor=skip_post_processor), pipeline.source(index)
+
+        def reuse(function):
+            if id(function) in evaluated:
+                value = evaluated[id(function)]
+                return lambda *_, **__: value
+            return function
+
+        value = reuse(pipeline.source)(index)
+        source = value.copy() if hasattr(value, 'copy') else value
+        for bucket in pipeline.mutators:
+            for mutator in bucket:
+                value = pipeline.combiner(value, reuse(mutator), index)
+        if pipeline.post_processor and not skip_post_processor:
+            value = pipeline.post_processor(value, pipeline.manager.step_size())
+        return value, source
+
+
+def _is_replayable(pipeline) -> bool:
+    return all(hasattr(pipeline, attribute) for attribute in ['source', 'mutators', 'combiner',
+                                                                'post_processor', 'manager'])
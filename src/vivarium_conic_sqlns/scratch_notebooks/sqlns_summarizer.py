@@ -1,6 +1,9 @@
 import numpy as np, pandas as pd
+import re
 # import os
 from collections import Counter
+from collections.abc import MutableMapping
+from functools import lru_cache
 #from neonatal.tabulation import risk_mapper
 
 # Used in .find_columns() method to categorize all columns in the data.
@@ -104,6 +107,146 @@ def quantile_025(x: pd.Series) -> float:
 def quantile_975(x: pd.Series) -> float:
     return x.quantile(0.975)
 
+class ColumnSchema():
+    """
+    The column categories and the fields in the column names of one set of output columns.
+    Each column name is matched against the category search regexes once, when the schema is created, and against
+    a category's extraction regex once, the first time that category's fields are requested.
+    Use get_column_schema() to get one, so schemas are shared between summarizers with the same columns.
+    """
+
+    def __init__(self, columns, column_categories_to_search_regexes):
+        self.columns = pd.Index(columns)
+        names = [str(column) for column in columns]
+        # Positions of the columns in each category, in column order.
+        # (pd.DataFrame.filter(regex=...) also uses re.search on the string form of each column name.)
+        self.positions = {}
+        for category, cat_regex in column_categories_to_search_regexes.items():
+            search = re.compile(cat_regex).search
+            self.positions[category] = np.array([i for i, name in enumerate(names) if search(name) is not None],
+                                                dtype=np.int64)
+        self._fields = {}
+
+    def category_columns(self, category):
+        """Get the column names in the specified category."""
+        return self.columns[self.positions[category]]
+
+    def fields(self, category, extraction_regex):
+        """
+        Get a DataFrame with one row per column in the category and one column per named group in the
+        extraction regex, the same as column_names.str.extract(extraction_regex).
+        """
+        if (category, extraction_regex) not in self._fields:
+            regex = re.compile(extraction_regex)
+            group_names = dict(zip(regex.groupindex.values(), regex.groupindex.keys()))
+            field_names = [group_names.get(1 + i, i) for i in range(regex.groups)]
+            records = []
+            for name in self.category_columns(category):
+                match = regex.search(name)
+                records.append([np.nan] * regex.groups if match is None
+                               else [np.nan if field is None else field for field in match.groups()])
+            self._fields[(category, extraction_regex)] = pd.DataFrame(records, columns=field_names, dtype=object)
+        return self._fields[(category, extraction_regex)]
+
+    def column_index(self, category, extraction_regex):
+        """Get a MultiIndex of the fields extracted from the column names in the category, omitting empty fields."""
+        return pd.MultiIndex.from_frame(self.fields(category, extraction_regex).dropna(axis=1, how='all'))
+
+@lru_cache(maxsize=32)
+def _get_column_schema(columns: tuple, column_categories_to_search_regexes: tuple) -> ColumnSchema:
+    return ColumnSchema(columns, dict(column_categories_to_search_regexes))
+
+def get_column_schema(columns, column_categories_to_search_regexes):
+    """Get the (cached) ColumnSchema for a set of column names and a dictionary of category search regexes."""
+    return _get_column_schema(tuple(columns), tuple(column_categories_to_search_regexes.items()))
+
+def with_float_block(data):
+    """
+    Get a DataFrame equal to the data whose float columns all share one 2-D array (rows by columns, in column
+    order), and that array. A DataFrame made from a slice of adjacent columns of the array shares memory with
+    the returned DataFrame rather than copying it.
+    If the data's columns are all floats stored in one block, `data.values` is a view of that block, so the data
+    itself is returned and nothing is copied. Otherwise the returned DataFrame is a copy of the data built around
+    a new array.
+    The returned array is read-only, so DataFrames sliced from it can't be used to change the data.
+    """
+    is_float = (data.dtypes == np.float64).values
+    if is_float.all():
+        values = data.values
+        if len(data.columns) and np.may_share_memory(values, data.iloc[:, 0].values):
+            values.setflags(write=False)
+            return data, values
+    else:
+        values = data.loc[:, is_float].values
+
+    block_data = pd.DataFrame(values, index=data.index, columns=data.columns[is_float], copy=False)
+    for position in np.flatnonzero(~is_float):
+        block_data.insert(int(position), data.columns[position], data.iloc[:, position].values,
+                          allow_duplicates=True)
+    values.setflags(write=False)
+    return block_data, values
+
+class CategoryViews(MutableMapping):
+    """
+    Dictionary-like access to a sub-DataFrame of the columns in each category, built on first access from the
+    category's column positions in the schema rather than copied out for every category up front.
+    A category of adjacent float columns is a slice of the array backing the data's float columns (see
+    with_float_block()), so it shares the data's memory. The array is read-only, so the category's values can't be
+    changed in place, but changing the data changes them too.
+    Other categories are copied from the data when they're first used. Index levels used as columns (after
+    sum_over_random_seeds()) are taken from the index, so the data never has to be concatenated with its index.
+    Assigning a category replaces its sub-DataFrame, as with a dictionary.
+    """
+
+    def __init__(self, data, float_values, schema, index_columns=()):
+        self._data = data
+        self._float_values = float_values
+        self._schema = schema
+        self._n_index = len(index_columns)
+        self._categories = list(schema.positions)
+        self._views = {}
+        # Position of each data column in the float array, or -1 if it isn't a float column
+        is_float = (data.dtypes == np.float64).values
+        self._float_positions = np.where(is_float, np.cumsum(is_float) - 1, -1)
+
+    def __getitem__(self, category):
+        if category not in self._views:
+            if category not in self._categories:
+                raise KeyError(category)
+            self._views[category] = self._get_view(self._schema.positions[category])
+        return self._views[category]
+
+    def __setitem__(self, category, cat_data):
+        if category not in self._categories:
+            self._categories.append(category)
+        self._views[category] = cat_data
+
+    def __delitem__(self, category):
+        self._categories.remove(category)
+        self._views.pop(category, None)
+
+    def __iter__(self):
+        return iter(self._categories)
+
+    def __len__(self):
+        return len(self._categories)
+
+    def _get_view(self, positions):
+        index_positions = positions[positions < self._n_index]
+        data_positions = positions[positions >= self._n_index] - self._n_index
+        float_positions = self._float_positions[data_positions]
+
+        if len(float_positions) and (float_positions >= 0).all() and (np.diff(float_positions) == 1).all():
+            values = self._float_values[:, float_positions[0]:float_positions[-1] + 1]
+            cat_data = pd.DataFrame(values, index=self._data.index, columns=self._data.columns[data_positions],
+                                    copy=False)
+        else:
+            cat_data = self._data.iloc[:, data_positions]
+        if len(index_positions):
+            index_data = self._data.index.to_frame().iloc[:, index_positions]
+            cat_data = pd.concat([index_data, cat_data], axis='columns')
+        return cat_data
+
 class SQLNSOutputSummarizer():
     """Class to provide functions to summarize output from neonatal model"""
     
@@ -118,6 +261,7 @@ class SQLNSOutputSummarizer():
 #                         for column_category, column_names in self.columns.items()}
         self.column_categories_to_extraction_regexes = None
         self.index_columns = None
+        self._block_data = None
         # Initializes self.subdata,
         # self.found_columns, self.missing_columns, self.repeated_columns, self.empty_categories:
         self.categorize_data_by_column()
@@ -132,32 +276,40 @@ class SQLNSOutputSummarizer():
         elif self.column_categories_to_search_regexes is None:
             self.column_categories_to_search_regexes = default_column_categories_to_search_regexes()
             
-        if self.index_columns is not None:
-            all_data = pd.concat([self.data.index.to_frame(), self.data], axis='columns')
-        else:
-            all_data = self.data
-        
-        # Create dictionary mapping each column category to a sub-dataframe of columns in that category
-        self.subdata = {category: all_data.filter(regex=cat_regex)
-                        for category, cat_regex in self.column_categories_to_search_regexes.items()}
+        # Columns of the index (after sum_over_random_seeds()) are categorized along with the data columns
+        index_columns = list(self.data.index.names) if self.index_columns is not None else []
+
+        # Parse the column names (or reuse the parsed columns if we've seen these columns and regexes before)
+        self.schema = get_column_schema([*index_columns, *self.data.columns], self.column_categories_to_search_regexes)
+
+        # Back the data's float columns with one array for the sub-dataframes to slice into
+        # (unless they already are, e.g. when only the regexes have changed)
+        if self.data is not self._block_data:
+            self.data, self._float_values = with_float_block(self.data)
+            self._block_data = self.data
+
+        # Create dictionary mapping each column category to a sub-dataframe of columns in that category.
+        # The sub-dataframes are only built when they're used, and share the data's memory where possible.
+        self.subdata = CategoryViews(self.data, self._float_values, self.schema, index_columns)
             
         # Create dictionary mapping each column category to a pd.Index of column names in that category
         # 2019-07-18: Eliminating this attribute in favor of accessing column names via subdata frames.
         # 2019-07-26: Reinstating this attribute to retain original column names vs. only MultiIndices after parsing.
 #         self.columns = {category: self.data.filter(regex=cat_regex).columns
 #                         for category, cat_regex in self.column_categories_to_search_regexes.items()}
-        self._columns = pd.Series({category: df.columns for category, df in self.subdata.items()})
+        self._columns = pd.Series({category: self.schema.category_columns(category)
+                                   for category in self.schema.positions})
 
         # Get a list (or pd.Series) of the found columns to check for missing or duplicate columns
         # found_columns = pd.concat(pd.Series(col_names) for col_names in columns.values())
-        self.found_columns = [column for cat_data in self.subdata.values() for column in cat_data.columns]
+        self.found_columns = [column for columns in self._columns for column in columns]
 
         # Find any missing or duplicate columns
         self.missing_columns = set(self.data.columns) - set(self.found_columns)
         self.repeated_columns = {column_name: count for column_name, count in Counter(self.found_columns).items() if count > 1}
 
         # Also find any categories that didn't return a match
-        self.empty_categories = [category for category, cat_data in self.subdata.items() if len(cat_data.columns) == 0]
+        self.empty_categories = [category for category, columns in self._columns.items() if len(columns) == 0]
         
     def print_column_report(self):
         """
@@ -181,7 +333,7 @@ class SQLNSOutputSummarizer():
     
     def column_category_counts(self):
         """Get a dictionary mapping column categories to the number of columns found in that category."""
-        return {category: len(cat_data.columns) for category, cat_data in self.subdata.items()}
+        return {category: len(columns) for category, columns in self._columns.items()}
         
     def column_categories(self):
         """Get the list of column categories."""
@@ -259,10 +411,8 @@ class SQLNSOutputSummarizer():
 #         self.subdata = {}
         for category, extraction_regex in self.column_categories_to_extraction_regexes.items():
 #             print(category)
-            column_decompositions = self.subdata[category].columns.str.extract(extraction_regex)
-#             print(column_decompositions)
-            # Note: pd.MultiIndex.from_frame() requires pandas 0.24 or higher. If using version 0.23 or lower, instead use:
-            # pd.MultiIndex.from_tuples(column_decomposition.itertuples(index=False), names=column_decomposition.columns)
-            self.subdata[category].columns = pd.MultiIndex.from_frame(column_decompositions.dropna(axis=1, how='all'))
+            # The schema parses each column name once per extraction regex, and reuses the result afterwards.
+            # Note: pd.MultiIndex.from_frame() requires pandas 0.24 or higher.
+            self.subdata[category].columns = self.schema.column_index(category, extraction_regex)
 
 
@@ -0,0 +1,134 @@
+"""
+Command line entry point for post-processing SQ-LNS results.
+
+Processes every location under a results root laid out as 'results_root/location/run_date/output.hdf'
+(the most recent run of each location, unless run dates are given), using the branch configuration
+keys in a branches file (e.g. model_specifications/branches_sqlns_full.yaml) as the scenario columns:
+
+    process_sqlns_results /share/costeffectiveness/results/sqlns/presentation branches_sqlns_full.yaml -o summaries
+
+Locations are processed in parallel, and each location's final summary table is written to
+'output_dir/location_summary.csv'.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import click
+import pandas as pd
+import yaml
+
+from .sqlns_output_processing import parse_output_columns, process_output
+
+COVERAGE_KEY = 'sqlns.program_coverage'
+COVERAGE_COLUMN = 'coverage'
+
+
+def get_branch_keys(branches_file: str) -> list:
+    """Returns the dotted configuration keys (e.g. 'sqlns.effect_on_iron_deficiency.mean') varied in a branches file."""
+    with open(branches_file) as f:
+        branches = yaml.safe_load(f)['branches']
+
+    def flatten(config, prefix=''):
+        for key, value in config.items():
+            if isinstance(value, dict):
+                yield from flatten(value, f'{prefix}{key}.')
+            else:
+                yield f'{prefix}{key}'
+
+    return list(dict.fromkeys(key for branch in branches for key in flatten(branch)))
+
+
+def get_colname_mapper(branch_keys: list) -> dict:
+    """Maps branch configuration keys to short column names, e.g. 'sqlns.effect_on_iron_deficiency.mean' to
+    'iron_deficiency_mean' and 'sqlns.program_coverage' to 'coverage'."""
+    mapper = {key: '_'.join(key.split('.')[1:]).replace('effect_on_', '') for key in branch_keys}
+    if COVERAGE_KEY in mapper:
+        mapper[COVERAGE_KEY] = COVERAGE_COLUMN
+    return mapper
+
+
+def get_cause_names(output_path: str) -> list:
+    """Returns the causes with death, YLL or YLD columns in an output file."""
+    with pd.HDFStore(output_path, mode='r') as store:
+        storer = store.get_storer(store.keys()[0])
+        columns = storer.non_index_axes[0][1] if storer.is_table else store.select(store.keys()[0], stop=0).columns
+    causes = parse_output_columns(tuple(columns))['cause'].dropna()
+    return [cause for cause in pd.unique(causes) if cause != 'all_causes']
+
+
+def get_latest_run_dates(results_root: str) -> dict:
+    """Maps each location directory under the results root to its most recent run with an output file."""
+    run_dates = {}
+    for location in sorted(os.listdir(results_root)):
+        location_dir = os.path.join(results_root, location)
+        if not os.path.isdir(location_dir):
+            continue
+        runs = [run for run in sorted(os.listdir(location_dir))
+                if os.path.exists(os.path.join(location_dir, run, 'output.hdf'))]
+        if runs:
+            run_dates[location] = runs[-1]
+    return run_dates
+
+
+def process_location(location, run_dir, colname_mapper, index_cols, cause_names, output_dir, cache_dir,
+                     chunksize=None):
+    start = time.time()
+    causes = cause_names or get_cause_names(os.path.join(run_dir, 'output.hdf'))
+    final = process_output(run_dir, 'output.hdf', colname_mapper, index_cols, COVERAGE_COLUMN, causes,
+                           cache_dir=os.path.join(cache_dir, location) if cache_dir else None,
+                           chunksize=chunksize, stage='final')
+    output_path = os.path.join(output_dir, f'{location}_summary.csv')
+    final.to_csv(output_path)
+    return location, output_path, time.time() - start
+
+
+@click.command()
+@click.argument('results_root', type=click.Path(exists=True, file_okay=False))
+@click.argument('branches_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output-dir', '-o', type=click.Path(file_okay=False), default='.',
+              help='Directory to write the summary tables to.')
+@click.option('--location', '-l', 'locations', multiple=True,
+              help='Location to process, optionally with a run date as LOCATION=RUN_DATE. '
+                   'Defaults to the most recent run of every location.')
+@click.option('--cause', '-c', 'cause_names', multiple=True,
+              help='Cause to report. Defaults to every cause in the output.')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help='Directory for cached intermediate results. Defaults to a folder next to each output file.')
+@click.option('--workers', '-w', type=int, default=None,
+              help='Number of locations to process at once. Defaults to the number of CPUs.')
+@click.option('--chunksize', type=int, default=None,
+              help='Aggregate each output file this many rows at a time instead of loading it whole.')
+def process_results(results_root, branches_file, output_dir, locations, cause_names, cache_dir, workers,
+                    chunksize):
+    """Summarizes the SQ-LNS results for every location under RESULTS_ROOT, using the branches in BRANCHES_FILE
+    to identify scenarios."""
+    colname_mapper = get_colname_mapper(get_branch_keys(branches_file))
+    if COVERAGE_COLUMN not in colname_mapper.values():
+        raise click.BadParameter(f'{branches_file} does not vary {COVERAGE_KEY}.', param_hint='BRANCHES_FILE')
+    index_cols = list(colname_mapper.values()) + ['input_draw']
+
+    latest_run_dates = get_latest_run_dates(results_root)
+    if locations:
+        run_dates = {}
+        for location in locations:
+            location, _, run_date = location.partition('=')
+            run_dates[location] = run_date or latest_run_dates.get(location)
+            if (run_dates[location] is None
+                    or not os.path.exists(os.path.join(results_root, location, run_dates[location], 'output.hdf'))):
+                raise click.BadParameter(f'No output found for {location}.', param_hint='--location')
+    else:
+        run_dates = latest_run_dates
+    if not run_dates:
+        raise click.ClickException(f'No output files found under {results_root}.')
+
+    os.makedirs(output_dir, exist_ok=True)
+    click.echo(f'Processing {len(run_dates)} locations with scenario columns {index_cols[:-1]}')
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [executor.submit(process_location, location, os.path.join(results_root, location, run_date),
+                                   colname_mapper, index_cols, list(cause_names), output_dir, cache_dir,
+                                   chunksize)
+                   for location, run_date in run_dates.items()]
+        for future in as_completed(futures):
+            location, output_path, elapsed = future.result()
+            click.echo(f'{location}: wrote {output_path} in {elapsed:.1f}s')
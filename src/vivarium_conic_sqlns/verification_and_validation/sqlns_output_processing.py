@@ -11,8 +11,22 @@ output = sop.load_output(result_dir, 'output.hdf')
 df = sop.get_transformed_data(output)
 averted_df = sop.get_averted_results(df)
 aggregated_df = sop.get_final_table(averted_df)
+
+`process_output` runs the same chain, caching each stage's result on disk so reruns only recompute
+the stages whose inputs or parameters changed.
 """
 
+import hashlib
+import itertools
+import json
+import os
+import re
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
+import numpy as np
 import pandas as pd
 
 # cause_names = ['lower_respiratory_infections', 'measles', 'diarrheal_diseases', 
@@ -43,21 +57,149 @@ def load_output(path, filename):
     r = pd.read_hdf(f'{path}/{filename}')
     return r
 
-def load_by_location_and_rundate(base_directory: str, locations_run_dates: dict) -> pd.DataFrame:
-    """Load output.hdf files from folders namedd with the convention 'base_directory/location/rundate/output.hdf'"""
-    
+# Columns identifying a simulation in output.hdf, besides the branch configuration columns
+# (which are the dotted configuration keys, e.g. 'sqlns.program_coverage').
+SIMULATION_COLUMNS = ['input_draw', 'random_seed']
+
+def convert_output_to_table_format(path, filename='output.hdf', table_filename='output_table.hdf', group_size=200):
+    """
+    Converts an output file to a queryable copy in HDF table format, unless an up-to-date copy already exists.
+    The branch configuration and simulation columns are stored under the 'branches' key as data columns,
+    so rows can be selected by their values without reading the measures. The measure columns are
+    split into groups of `group_size` columns stored under 'measures_000', 'measures_001', etc., so only the groups
+    holding the requested columns have to be read. Returns the path to the converted file.
+    """
+    source = f'{path}/{filename}'
+    target = f'{path}/{table_filename}'
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+        return target
+
+    output = pd.read_hdf(source)
+    branch_columns = [c for c in output.columns if '.' in c or c in SIMULATION_COLUMNS]
+    measure_columns = [c for c in output.columns if c not in branch_columns]
+
+    # Write to a temporary file first so an interrupted conversion isn't mistaken for a finished one.
+    with warnings.catch_warnings():
+        # Dotted configuration keys aren't valid PyTables natural names, which is only a problem for attribute access.
+        warnings.filterwarnings('ignore', message='object name is not a valid Python identifier')
+        with pd.HDFStore(f'{target}.tmp', mode='w', complevel=5, complib='zlib') as store:
+            store.append('branches', output[branch_columns], data_columns=branch_columns)
+            for i in range(0, len(measure_columns), group_size):
+                store.append(f'measures_{i // group_size:03d}', output[measure_columns[i:i + group_size]])
+    os.replace(f'{target}.tmp', target)
+    return target
+
+def load_output_subset(path, filename='output.hdf', columns=(), column_patterns=(), filters=None,
+                       chunksize=500_000):
+    """
+    Loads only the requested columns and rows of an output file.
+    Columns are those named in `columns` plus any matching one of the regular expressions in `column_patterns`
+    (e.g. the values of `sqlns_summarizer.default_column_categories_to_search_regexes`).
+    `filters` maps branch configuration or simulation columns to a value or a list of values to keep, e.g.
+    {'sqlns.duration': 365.25, 'sqlns.program_coverage': [0, 0.2]}.
+    The output is converted to table format on first use (see `convert_output_to_table_format`).
+    Branch configuration and simulation columns come first in the result, followed by the measures in file order.
+    """
+    patterns = [re.compile(pattern) for pattern in column_patterns]
+    with pd.HDFStore(convert_output_to_table_format(path, filename), mode='r') as store:
+        stored_columns = {key: list(store.get_storer(key).non_index_axes[0][1]) for key in sorted(store.keys())}
+        all_columns = [c for key_columns in stored_columns.values() for c in key_columns]
+        wanted = set(columns) | {c for c in all_columns if any(pattern.search(c) for pattern in patterns)}
+        missing = set(columns) - set(all_columns)
+        if missing:
+            raise KeyError(f'Columns not found in {path}/{filename}: {sorted(missing)}')
+
+        coordinates = None
+        if filters:
+            unknown = set(filters) - set(stored_columns['/branches'])
+            if unknown:
+                raise ValueError('Only branch configuration and simulation columns can be filtered on, '
+                                 f'got {sorted(unknown)}')
+            keep = np.ones(store.get_storer('branches').nrows, dtype=bool)
+            for column, value in filters.items():
+                column_values = store.select_column('branches', column).values
+                keep &= np.isin(column_values, value if pd.api.types.is_list_like(value) else [value])
+            coordinates = np.flatnonzero(keep)
+
+        pieces = [_select_chunked(store, key, [c for c in key_columns if c in wanted], coordinates, chunksize)
+                  for key, key_columns in stored_columns.items() if wanted.intersection(key_columns)]
+
+    output = pd.concat(pieces, axis=1, copy=False) if pieces else pd.DataFrame()
+    return output[[c for c in all_columns if c in wanted]]
+
+def _select_chunked(store, key, columns, coordinates, chunksize):
+    """Selects `columns` from the rows of `key` at `coordinates` (all rows if None), `chunksize` rows at a time."""
+    if coordinates is None:
+        nrows = store.get_storer(key).nrows
+        chunks = [store.select(key, columns=columns, start=start, stop=start + chunksize)
+                  for start in range(0, nrows, chunksize)]
+    else:
+        chunks = [store.select(key, where=coordinates[start:start + chunksize], columns=columns)
+                  for start in range(0, len(coordinates), chunksize)]
+    return pd.concat(chunks, copy=False) if chunks else store.select(key, columns=columns, start=0, stop=0)
+
+def load_by_location_and_rundate(base_directory: str, locations_run_dates: dict, columns=None,
+                                 max_workers=None) -> pd.DataFrame:
+    """Load output.hdf files from folders namedd with the convention 'base_directory/location/rundate/output.hdf'
+
+    Locations are read concurrently in a pool of `max_workers` processes (one per location by default;
+    pass 1 to read them one after another). If `columns` is given, only those columns are read from each
+    file (see `_read_location_output`) and sent back from the workers. The returned 'location' column is
+    categorical, with categories in the order of `locations_run_dates`.
+    """
     # Use dictionary to map countries to the correct path for the Vivarium output to process
     # E.g. /share/costeffectiveness/results/sqlns/bangladesh/2019_06_21_00_09_53
     locactions_paths = {location: f'{base_directory}/{location.lower()}/{run_date}/output.hdf'
                        for location, run_date in locations_run_dates.items()}
 
     # Read in data from different countries
-    locations_outputs = {location: pd.read_hdf(path) for location, path in locactions_paths.items()}
+    start = time.time()
+    locations_outputs = {}
+    if max_workers == 1:
+        results = (_read_location_output(location, path, columns) for location, path in locactions_paths.items())
+        for location, output, elapsed in results:
+            locations_outputs[location] = output
+            _report_loaded(location, output, elapsed, len(locations_outputs), len(locactions_paths))
+    else:
+        max_workers = max_workers or len(locactions_paths)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_read_location_output, location, path, columns)
+                       for location, path in locactions_paths.items()]
+            for future in as_completed(futures):
+                location, output, elapsed = future.result()
+                locations_outputs[location] = output
+                _report_loaded(location, output, elapsed, len(locations_outputs), len(locactions_paths))
+    print(f'Loaded {len(locations_outputs)} locations in {time.time() - start:.1f}s')
 
-    for location, output in locations_outputs.items():
-        output['location'] = location
-    
-    return pd.concat(locations_outputs.values(), copy=False, sort=False)
+    locations = list(locactions_paths)
+    outputs = [locations_outputs[location] for location in locations]
+    all_output = pd.concat(outputs, copy=False, sort=False)
+    location_codes = np.repeat(np.arange(len(locations)), [len(output) for output in outputs])
+    all_output['location'] = pd.Categorical.from_codes(location_codes, categories=locations)
+    return all_output
+
+def _read_location_output(location, path, columns=None):
+    """Reads one location's output file, returning it with the time it took to read.
+
+    Column pruning needs table format. A fixed format file has to be read whole, so `columns` are read
+    from its table format copy instead (see `load_output_subset`), which is made on first use.
+    """
+    start = time.time()
+    with pd.HDFStore(path, mode='r') as store:
+        key = store.keys()[0]
+        if columns is None:
+            output = store.get(key)
+        elif store.get_storer(key).is_table:
+            output = store.select(key, columns=columns)
+        else:
+            output = None
+    if output is None:
+        directory, filename = os.path.split(path)
+        output = load_output_subset(directory, filename, columns=columns)[list(columns)]
+    return location, output, time.time() - start
+
+def _report_loaded(location, output, elapsed, done, total):
+    print(f'[{done}/{total}] {location}: {output.shape[0]} rows x {output.shape[1]} columns in {elapsed:.1f}s')
     
 def print_location_output_shapes(locations, all_output):
     """Print the shapes of outputs for each location to check whether all the same size or if some data is missing"""
@@ -77,9 +219,73 @@ def clean_and_aggregate(r, colname_mapper, index_cols, coverage_col):
     r[coverage_col] *= 100
 
 #     r = r.groupby(['coverage', 'duration', 'child_stunting_permanent', 'child_wasting_permanent', 'iron_deficiency_permanent', 'iron_deficiency_mean', 'input_draw']).sum()
-    r = r.groupby(index_cols).sum()
+    r = r.groupby(index_cols, observed=True).sum()
     return r
 
+def aggregate_output_by_chunks(path, filename, colname_mapper, index_cols, coverage_col, chunksize=100_000,
+                               seed_count_column=None):
+    """
+    Out-of-core version of `load_output` followed by `clean_and_aggregate`, giving exactly the same result
+    without holding the raw output in memory.
+    The output is read `chunksize` rows at a time, cleaned the same way, and each chunk's numeric columns are
+    folded into running sums per `index_cols` group, adding rows in file order (so float sums match
+    groupby().sum() bit for bit). Missing values count as zero, as in groupby().sum().
+    If `seed_count_column` is given, a column of that name counts the rows (random seeds) summed in each group.
+    """
+    group_ids = {}
+    sums = None
+    counts = np.zeros(0, dtype=np.int64)
+    columns = None
+
+    with pd.HDFStore(f'{path}/{filename}', mode='r') as store:
+        key = store.keys()[0]
+        start = 0
+        while True:
+            chunk = store.select(key, start=start, stop=start + chunksize)
+            if chunk.empty:
+                break
+            start += chunksize
+
+            chunk = chunk.rename(columns=colname_mapper)
+            chunk[coverage_col] *= 100
+            if columns is None:
+                columns = [c for c in chunk.columns if c not in index_cols
+                           and pd.api.types.is_numeric_dtype(chunk[c]) and not pd.api.types.is_bool_dtype(chunk[c])]
+                sums = {c: np.zeros(0, dtype=np.float64 if pd.api.types.is_float_dtype(chunk[c]) else np.int64)
+                        for c in columns}
+
+            # Map this chunk's groups onto groups numbered across the whole file. Rows with a missing index
+            # value aren't in any group (ngroup gives them -1, or NaN in later pandas versions).
+            chunk_group = chunk.groupby(index_cols, sort=False, observed=True).ngroup().values
+            in_group = chunk_group >= 0
+            chunk_group = chunk_group[in_group].astype(np.int64)
+            first_rows = np.flatnonzero(in_group)[np.unique(chunk_group, return_index=True)[1]]
+            # Keys are taken column by column so integer columns aren't upcast alongside float ones.
+            chunk_keys = zip(*[chunk[c].values[first_rows].tolist() for c in index_cols])
+            group = np.array([group_ids.setdefault(k, len(group_ids)) for k in chunk_keys],
+                             dtype=np.int64)[chunk_group]
+
+            if len(group_ids) > len(counts):
+                counts = np.concatenate([counts, np.zeros(len(group_ids) - len(counts), dtype=np.int64)])
+                for c in columns:
+                    sums[c] = np.concatenate([sums[c], np.zeros(len(group_ids) - len(sums[c]), dtype=sums[c].dtype)])
+
+            np.add.at(counts, group, 1)
+            for c in columns:
+                values = chunk[c].values[in_group]
+                if sums[c].dtype.kind == 'f':
+                    values = np.where(np.isnan(values), 0., values)
+                np.add.at(sums[c], group, values)
+
+    index = pd.MultiIndex.from_tuples(list(group_ids), names=index_cols)
+    result = pd.DataFrame(sums, index=index, columns=columns)
+    if seed_count_column is not None:
+        result[seed_count_column] = counts
+    result = result.sort_index()
+    if len(index_cols) == 1:
+        result.index = result.index.get_level_values(0)
+    return result
+
 def standardize_shape(data, measure, index_cols):
     measure_data = data.loc[:, [c for c in data.columns if measure in c]]
     index_level = len(index_cols)
@@ -96,88 +302,129 @@ def standardize_shape(data, measure, index_cols):
     
     return measure_data
 
+# All-cause output columns and the measure column names they correspond to.
+ALL_CAUSE_COLUMNS = {'total_population_dead': 'death_due_to_all_causes',
+                     'years_of_life_lost': 'ylls_due_to_all_causes',
+                     'years_lived_with_disability': 'ylds_due_to_all_causes'}
+
+MEASURES = ['death', 'ylls', 'ylds', 'dalys', 'person_time', 'sqlns_treated_days']
+
+STRATA = ['year', 'sex', 'age_group']
+
+# Stratum label for measures that aren't stratified that way (e.g. the all-cause columns).
+UNSTRATIFIED = 'all'
+
+# e.g. 'ylds_due_to_diarrheal_diseases_in_2020_among_male_in_age_group_early_neonatal', 'person_time',
+# 'death_due_to_other_causes'
+OUTPUT_COLUMN_REGEX = (r'^(?P<measure>death|ylls|ylds|person_time|sqlns_treated_days)'
+                       r'(?:_due_to_(?P<cause>\w+?))?(?:_in_(?P<year>\d{4}))?(?:_among_(?P<sex>male|female))?'
+                       r'(?:_in_age_group_(?P<age_group>\w+))?$')
+
+@lru_cache(maxsize=16)
+def parse_output_columns(columns: tuple) -> pd.DataFrame:
+    """
+    Parses output column names into their measure, cause, year, sex and age group.
+    Returns a dataframe indexed by the column names that could be parsed, with a column for each part
+    (missing where the column isn't stratified that way). Results are cached by the tuple of column names.
+    """
+    names = pd.Series(list(columns), index=list(columns))
+    parsed = names.replace(ALL_CAUSE_COLUMNS).str.extract(OUTPUT_COLUMN_REGEX)
+    return parsed.dropna(subset=['measure'])
+
+def melt_output(data, index_cols, measures=MEASURES, causes=None):
+    """
+    Reshapes the measure columns of `data` (indexed by `index_cols`) into "long" form in one pass.
+    Every column name is parsed once (see `parse_output_columns`), and the result has the index columns,
+    then 'cause' (if any selected column has one), the year, sex and age group strata the selected columns are
+    stratified by, and 'measure' and 'value' columns. 'cause', 'measure' and the strata are categorical.
+    A stratum is `UNSTRATIFIED` ('all') for selected columns that aren't stratified that way.
+    Only columns for the given `measures` (and `causes`, if given) are included. If 'dalys' is one of the
+    measures, DALYs are derived from the YLL and YLD columns (see `add_dalys`). Missing values are dropped.
+    """
+    parsed = parse_output_columns(tuple(data.columns))
+    selected = parsed['measure'].isin(set(measures) | ({'ylls', 'ylds'} if 'dalys' in measures else set()))
+    if causes is not None:
+        selected &= parsed['cause'].isin(causes)
+    parsed = parsed[selected]
+    values = data[parsed.index].values
+
+    if 'dalys' in measures:
+        values, parsed = add_dalys(values, parsed)
+        requested = parsed['measure'].isin(measures).values
+        values, parsed = values[:, requested], parsed[requested]
+
+    n_rows, n_columns = values.shape
+
+    long = {}
+    index = data.index.to_frame(index=False)
+    for col in index_cols:
+        long[col] = np.repeat(index[col].values, n_columns)
+
+    part_categories = {'cause': list(causes) if causes is not None else None, 'measure': list(measures)}
+    for part in ['cause'] + STRATA + ['measure']:
+        if parsed[part].isnull().all():
+            continue
+        categories = part_categories.get(part)
+        if categories is None:
+            categories = list(pd.unique(parsed[part].dropna()))
+        parts = parsed[part]
+        if part in STRATA and parts.isnull().any():
+            categories = categories + [UNSTRATIFIED]
+            parts = parts.fillna(UNSTRATIFIED)
+        codes = pd.Categorical(parts, categories=categories).codes
+        long[part] = pd.Categorical.from_codes(np.tile(codes, n_rows), categories=categories)
+
+    long['value'] = values.ravel()
+    long = pd.DataFrame(long)
+    return long[long['value'].notnull().values].reset_index(drop=True)
+
+def add_dalys(values, parsed):
+    """
+    Derives DALY columns from a block of measure values and its parsed column names (see `parse_output_columns`).
+    DALYs for each cause and stratum are the sum of its YLL and YLD columns, with a missing YLL or YLD column
+    (or missing value) counting as zero, so a cause with only YLLs or only YLDs needs no special handling.
+    Returns the block and parsed column names with the DALY columns appended.
+    """
+    components = parsed['measure'].isin(['ylls', 'ylds']).values
+    if not components.any():
+        return values, parsed
+
+    key = ['cause'] + STRATA
+    strata = parsed.loc[components, key].reset_index(drop=True)
+    group = strata.fillna('').groupby(key, sort=False).ngroup().values
+    order = np.argsort(group, kind='mergesort')
+    starts = np.r_[0, np.flatnonzero(np.diff(group[order])) + 1]
+
+    dalys = np.add.reduceat(np.nan_to_num(values[:, components][:, order]), starts, axis=1)
+    daly_columns = strata.iloc[order[starts]].assign(measure='dalys')
+    parsed = pd.concat([parsed, daly_columns[parsed.columns]], ignore_index=True)
+    return np.hstack([values, dalys]), parsed
+
 def get_person_time(data, index_cols):
-    pt = standardize_shape(data, 'person_time', index_cols)
+    pt = melt_output(data, index_cols, measures=['person_time'])
     pt = pt.rename(columns={'value': 'person_time'}).drop(columns='measure')
     return pt
 
 def get_treated_days(data, index_cols):
-    treated = standardize_shape(data, 'sqlns_treated_days', index_cols)
+    treated = melt_output(data, index_cols, measures=['sqlns_treated_days'])
     treated = treated.rename(columns={'value': 'sqlns_treated_days'}).drop(columns='measure')
     return treated
 
 def get_disaggregated_results(data, cause_names, index_cols):
-    
-#     global template_cols
-    
-    deaths = []
-    ylls = []
-    ylds = []
-    dalys = []
-#     level = len(index_cols)
-    for cause in cause_names:
-        if cause in cause_names[:4]:
-            deaths.append(standardize_shape(data, f'death_due_to_{cause}', index_cols))
-            
-            ylls_sub = standardize_shape(data, f'ylls_due_to_{cause}', index_cols)
-            ylds_sub = standardize_shape(data, f'ylds_due_to_{cause}', index_cols)
-#             dalys_sub = (ylds_sub.set_index([c for c in template_cols if c != 'measure']) + \
-#                          ylls_sub.set_index([c for c in template_cols if c != 'measure'])).reset_index()
-            dalys_sub = (ylds_sub.set_index(index_cols+['cause']) + \
-                         ylls_sub.set_index(index_cols+['cause'])).reset_index()
-            dalys_sub['measure'] = 'dalys'
-            
-            ylls.append(ylls_sub)
-            ylds.append(ylds_sub)
-            dalys.append(dalys_sub)
-        elif cause == 'iron_deficiency':
-            ylds_sub = standardize_shape(data, f'ylds_due_to_{cause}', index_cols)     
-            dalys_sub = ylds_sub.copy()
-            dalys_sub['measure'] = 'dalys'
-            
-            ylds.append(ylds_sub)
-            dalys.append(dalys_sub)
-        else: # cause == 'other_causes'
-            deaths.append(standardize_shape(data, f'death_due_to_{cause}', index_cols))
-            
-            ylls_sub = standardize_shape(data, f'ylls_due_to_{cause}', index_cols)
-            dalys_sub = ylls_sub.copy()
-            dalys_sub['measure'] = 'dalys'
-            
-            ylls.append(ylls_sub)
-            dalys.append(dalys_sub)
-    
-    death_data = pd.concat(deaths, sort=False)
-    yll_data = pd.concat(ylls, sort=False)
-    yld_data = pd.concat(ylds, sort=False)
-    daly_data = pd.concat(dalys, sort=False)
-    
-    output = pd.concat([death_data, yll_data, yld_data, daly_data], sort=False)
-#     output = output.set_index(template_cols).sort_index()
-    output = output.set_index(index_cols + ['cause', 'measure']).sort_index()
-    
-    return output.reset_index()
+    """
+    Get deaths, YLLs, YLDs and DALYs by cause in "long" form.
+    """
+    return melt_output(data, index_cols, measures=['death', 'ylls', 'ylds', 'dalys'], causes=cause_names)
 
 def get_all_cause_results(data, index_cols):
-    all_cause_data = data[['total_population_dead', 
-                           'years_of_life_lost', 
-                           'years_lived_with_disability']].rename(
-        columns={'total_population_dead': 'death_due_to_all_causes',
-                 'years_of_life_lost': 'ylls_due_to_all_causes', 
-                 'years_lived_with_disability': 'ylds_due_to_all_causes'})
-    
-    all_cause_data['dalys_due_to_all_causes'] = (all_cause_data['ylls_due_to_all_causes'] 
-                                                 + all_cause_data['ylds_due_to_all_causes'])
-    
-    return pd.concat([standardize_shape(all_cause_data, column, index_cols)
-                      for column in all_cause_data.columns], sort=False)
+    return melt_output(data, index_cols, measures=['death', 'ylls', 'ylds', 'dalys'], causes=['all_causes'])
 
 def get_all_results(data, cause_names, index_cols):
     """
     Get transformed output disaggregated by cause and aggregated over all causes.
     """
-    return pd.concat([get_disaggregated_results(data, cause_names, index_cols),
-                      get_all_cause_results(data, index_cols)], sort=False)
+    return melt_output(data, index_cols, measures=['death', 'ylls', 'ylds', 'dalys'],
+                       causes=list(cause_names) + ['all_causes'])
 
 # def add_person_time_and_treated_days(output, data, index_cols):
 #     """
@@ -198,11 +445,76 @@ def get_transformed_data(data, cause_names, index_cols):
     
 #     r = clean_and_aggregate(output)
     all_results = get_all_results(data, cause_names, index_cols)
+    person_time = get_person_time(data, index_cols)
+    treated_days = get_treated_days(data, index_cols)
+    # Join on any strata the measures share too, so stratified person time lines up with stratified results.
+    # Totals over each stratum are added first, so results that aren't stratified the same way (e.g. the
+    # all-cause measures) are matched with the person time and treated days they cover.
+    person_time = add_strata_totals(person_time, 'person_time')
+    treated_days = add_strata_totals(treated_days, 'sqlns_treated_days')
     df = all_results.merge(
-        get_person_time(data, index_cols), on=index_cols).merge(
-        get_treated_days(data, index_cols), on=index_cols)
+        person_time, on=[c for c in person_time.columns if c in all_results.columns]).merge(
+        treated_days, on=[c for c in treated_days.columns if c in all_results.columns])
     return df
 
+def add_strata_totals(data, value_col):
+    """
+    Adds rows with `value_col` summed over every combination of the strata columns in `data`, labelled
+    `UNSTRATIFIED` ('all') in the strata summed over. Totals are only summed from stratified rows, and rows
+    already in the data take precedence over derived totals with the same key.
+    """
+    strata = [col for col in STRATA if col in data.columns]
+    if not strata:
+        return data
+    key = [col for col in data.columns if col != value_col]
+    data = data.copy()
+    for col in strata:
+        if UNSTRATIFIED not in data[col].cat.categories:
+            data[col] = data[col].cat.add_categories(UNSTRATIFIED)
+
+    totals = [data]
+    for n_summed in range(1, len(strata) + 1):
+        for summed in itertools.combinations(strata, n_summed):
+            stratified = data[(data[list(summed)] != UNSTRATIFIED).all(axis=1).values]
+            kept = [col for col in key if col not in summed]
+            total = stratified.groupby(kept, sort=False, observed=True)[value_col].sum().reset_index()
+            for col in summed:
+                total[col] = pd.Categorical.from_codes(
+                    np.full(len(total), list(data[col].cat.categories).index(UNSTRATIFIED)),
+                    categories=data[col].cat.categories)
+            totals.append(total[data.columns])
+
+    totals = pd.concat(totals, ignore_index=True)
+    for col in key:
+        if pd.api.types.is_categorical_dtype(data[col]):
+            totals[col] = totals[col].astype(data[col].dtype)
+    return totals.drop_duplicates(subset=key, keep='first').reset_index(drop=True)
+
+def fill_unstratified(data):
+    """
+    Labels missing strata (year, sex or age group) `UNSTRATIFIED`, so measures that aren't stratified that way
+    are grouped together rather than left out of the groups.
+    """
+    missing = [col for col in STRATA if col in data.columns and data[col].isnull().any()]
+    if not missing:
+        return data
+    data = data.copy()
+    for col in missing:
+        if pd.api.types.is_categorical_dtype(data[col]) and UNSTRATIFIED not in data[col].cat.categories:
+            data[col] = data[col].cat.add_categories(UNSTRATIFIED)
+        data[col] = data[col].fillna(UNSTRATIFIED)
+    return data
+
+def get_group_codes(data, by, sort):
+    """
+    Numbers the groups of the `by` columns in `data`, returning each row's group number.
+    Raises a ValueError if any of the `by` columns has missing values, since those rows belong to no group.
+    """
+    missing = [col for col in by if data[col].isnull().any()]
+    if missing:
+        raise ValueError(f'Cannot group rows with missing values in {missing}.')
+    return data.groupby(by, sort=sort, observed=True).ngroup().values
+
 def get_averted_results(df, index_cols, coverage_col):
     """
     Add columns for averted results by subtracting from baseline.
@@ -219,45 +531,188 @@ def get_averted_results(df, index_cols, coverage_col):
 #     # Original version:
 #     bau = df[df.coverage == 0.0].drop(columns=['coverage', 'sqlns_treated_days'])
 #     t = pd.merge(df, bau, on=template_cols[1:], suffixes=['', '_bau'])
-    bau = df[df[coverage_col] == 0.0].drop(columns=[coverage_col, 'sqlns_treated_days'])
-    t = pd.merge(df, bau,
-                 on = ['location', 'cause', 'measure'] + [col for col in index_cols if col != coverage_col],
-                 suffixes=['', '_bau'])
-    
+    # Rows are matched to the baseline (0% coverage) row with the same key by position rather than
+    # by merging, so the baseline columns are never materialized. Rows without a baseline are dropped.
+    df = fill_unstratified(df)
+    key = list(dict.fromkeys([col for col in ['location'] if col in df.columns] + ['cause', 'measure']
+                             + [col for col in index_cols if col != coverage_col]
+                             + [col for col in STRATA if col in df.columns]))
+    group = get_group_codes(df, key, sort=False)
+    is_baseline = (df[coverage_col] == 0.0).values
+    baseline_row = np.full(group.max() + 1 if len(group) else 0, -1)
+    baseline_row[group[is_baseline]] = np.flatnonzero(is_baseline)
+    baseline_row = baseline_row[group]
+    has_baseline = baseline_row >= 0
+
+    t = df[has_baseline].reset_index(drop=True)
+    value = t['value'].values
+    person_time = t['person_time'].values
+    treated_days = t['sqlns_treated_days'].values
+    value_bau = df['value'].values[baseline_row[has_baseline]]
+    person_time_bau = df['person_time'].values[baseline_row[has_baseline]]
+
     # Averted raw value
-    t['averted'] = t['value_bau'] - t['value']
+    averted = value_bau - value
+    t['averted'] = averted
     
     # Get value per 100,000 PY
-    t['value_rate'] = 100_000 * t['value'] / t['person_time']
+    value_rate = 100_000 * value / person_time
+    t['value_rate'] = value_rate
     
     # Averted value per 100,000 PY:
-    t['averted_rate'] = 100_000 * t['value_bau']/t['person_time_bau'] - t['value_rate']
+    averted_rate = 100_000 * value_bau / person_time_bau - value_rate
+    t['averted_rate'] = averted_rate
     
     # Treated days per averted DALY/YLL/YLD/death can be multiplied
     #  by cost per day of treatment to compute cost effectiveness.
     # Note that we have 0/0 in baseline - ICER ratio is undefined at 0% coverage.
-    t['treated_days_per_averted'] = t['sqlns_treated_days']/t['averted']
-    # This is an alternative calculation that is more numerically stable at the draw level.
-    # It will always be slightly less than treated_days/averted, but the values are comparable.
-    t['treated_days_per_averted_rate'] = 100_000*(t['sqlns_treated_days']/(t['person_time']*t['averted_rate']))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t['treated_days_per_averted'] = treated_days / averted
+        # This is an alternative calculation that is more numerically stable at the draw level.
+        # It will always be slightly less than treated_days/averted, but the values are comparable.
+        t['treated_days_per_averted_rate'] = 100_000 * (treated_days / (person_time * averted_rate))
     
     return t
 
+def summarize_draws(data, by, value_columns, percentiles=(.025, .975)):
+    """
+    Summarizes `value_columns` over the rows (draws) in each group of the `by` columns.
+    Returns a "long" dataframe with a row for each group and value column, holding the group's `by` values,
+    the name of the value column in 'column', and the same statistics as pandas' describe: 'count', 'mean',
+    'std', 'min', the percentiles (e.g. '2.5%', always including the median '50%') and 'max'.
+    Missing values are ignored. Each column is sorted within groups once, and every statistic is read off the
+    sorted values with vectorized array operations rather than group by group.
+    """
+    percentiles = sorted(set(percentiles) | {.5})
+    data = fill_unstratified(data)
+    group = get_group_codes(data, by, sort=True)
+    n_groups = group.max() + 1 if len(group) else 0
+    first_rows = np.unique(group, return_index=True)[1]
+    keys = data[by].iloc[first_rows].reset_index(drop=True)
+
+    summaries = []
+    for column in value_columns:
+        values = data[column].values.astype(float)
+        order = np.lexsort((values, group))  # Missing values sort to the end of each group.
+        sorted_values = values[order]
+        starts = np.r_[0, np.cumsum(np.bincount(group, minlength=n_groups))[:-1]]
+        present = ~np.isnan(values)
+        count = np.bincount(group[present], minlength=n_groups)
+        last = starts + np.maximum(count - 1, 0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.bincount(group[present], weights=values[present], minlength=n_groups) / count
+            squared_deviations = (values[present] - mean[group[present]]) ** 2
+            std = np.sqrt(np.bincount(group[present], weights=squared_deviations, minlength=n_groups) / (count - 1))
+            std[count < 2] = np.nan
+
+            summary = {'count': count.astype(float), 'mean': mean, 'std': std,
+                       'min': np.where(count > 0, sorted_values[starts], np.nan)}
+            for p in percentiles:
+                # Linear interpolation between the closest ranks, as in pandas' quantile.
+                position = p * (count - 1)
+                lower = np.floor(position).astype(int)
+                fraction = position - lower
+                low = sorted_values[starts + lower]
+                high = sorted_values[np.minimum(starts + lower + 1, last)]
+                interpolated = np.where(fraction > 0, low + fraction * (high - low), low)
+                summary[f'{p * 100:g}%'] = np.where(count > 0, interpolated, np.nan)
+            summary['max'] = np.where(count > 0, sorted_values[last], np.nan)
+
+        summary = pd.DataFrame(summary)
+        summary.insert(0, 'column', column)
+        summaries.append(pd.concat([keys, summary], axis=1))
+
+    return pd.concat(summaries, ignore_index=True)
+
 def get_final_table(data, index_cols):
     """
     Aggregate measures over draws to compute the mean and lower 2.5% and upper 97.5% percentiles.
-    Uses pandas DataFrame.describe() method, so it also returns median and standard deviation.
+    Also returns the count, standard deviation, min, median and max, laid out like pandas' describe()
+    (a column for each measure and statistic) on top of the "long" summary from `summarize_draws`.
     """
     # Group by all index columns except input_draw to aggregate over draws
-    aggregate_index = [col for col in index_cols if col != 'input_draw'] + ['cause', 'measure']
+    aggregate_index = ([col for col in index_cols if col != 'input_draw'] + ['cause', 'measure']
+                       + [col for col in STRATA if col in data.columns])
     # Original version: g = data.groupby(template_cols[:-1])[[]]
-    g = data.groupby(aggregate_index)[['value',
-                                          'person_time', 
-                                          'sqlns_treated_days',
-                                          'averted',
-                                          'averted_rate',
-                                          'treated_days_per_averted',
-                                          'treated_days_per_averted_rate',
-                                         ]]\
-            .describe(percentiles=[.025, .975]) # returns mean, stdev, median, percentiles .025 & .975
-    return g
\ No newline at end of file
+    value_columns = ['value',
+                     'person_time',
+                     'sqlns_treated_days',
+                     'averted',
+                     'averted_rate',
+                     'treated_days_per_averted',
+                     'treated_days_per_averted_rate',
+                     ]
+    summary = summarize_draws(data, aggregate_index, value_columns, percentiles=[.025, .975])
+    statistics = [c for c in summary.columns if c not in aggregate_index + ['column']]
+    g = summary.set_index(aggregate_index + ['column']).unstack('column')
+    g.columns = g.columns.swaplevel().rename([None, None])
+    return g[pd.MultiIndex.from_product([value_columns, statistics])]
+
+def process_output(path, filename, colname_mapper, index_cols, coverage_col, cause_names, cache_dir=None,
+                   chunksize=None, stage=None):
+    """
+    Runs load_output -> clean_and_aggregate -> get_transformed_data -> get_averted_results -> get_final_table,
+    returning the aggregated, transformed, averted and final tables. If `stage` is given ('aggregated',
+    'transformed', 'averted' or 'final'), only that stage's table is returned.
+    Each stage's result is cached as a pickle in `cache_dir` (default: a 'processing_cache' folder next to the
+    output file), named by a hash of the output file's path, modification time and size, and of the parameters of
+    that stage and every stage before it. Rerunning with the same inputs reads the cached results, and changing
+    a later stage's parameters only recomputes from that stage on. Stages are loaded lazily: a cached stage is
+    read without reading the stages before it, which are only loaded or computed when a stage they feed into
+    isn't cached. The names also include a hash of this module's source, so changing any of the processing code
+    recomputes every stage rather than reusing stale results.
+    If `chunksize` is given, the output is aggregated `chunksize` rows at a time with `aggregate_output_by_chunks`
+    rather than loaded whole. The result is the same, so it shares the cached results.
+    """
+    cache_dir = cache_dir if cache_dir is not None else f'{path}/processing_cache'
+    source = os.path.abspath(f'{path}/{filename}')
+    source_stat = os.stat(source)
+    source_key = {'source': source, 'mtime': source_stat.st_mtime_ns, 'size': source_stat.st_size}
+
+    aggregated = _CachedStage(cache_dir, 'aggregated', source_key,
+                              {'colname_mapper': colname_mapper, 'index_cols': index_cols, 'coverage_col': coverage_col},
+                              lambda: (aggregate_output_by_chunks(path, filename, colname_mapper, index_cols,
+                                                                  coverage_col, chunksize)
+                                       if chunksize else clean_and_aggregate(load_output(path, filename),
+                                                                             colname_mapper, index_cols,
+                                                                             coverage_col)))
+    transformed = _CachedStage(cache_dir, 'transformed', aggregated.key, {'cause_names': cause_names},
+                               lambda: get_transformed_data(aggregated.get(), cause_names, index_cols))
+    averted = _CachedStage(cache_dir, 'averted', transformed.key, {},
+                           lambda: get_averted_results(transformed.get(), index_cols, coverage_col))
+    final = _CachedStage(cache_dir, 'final', averted.key, {},
+                         lambda: get_final_table(averted.get(), index_cols))
+    stages = {'aggregated': aggregated, 'transformed': transformed, 'averted': averted, 'final': final}
+    if stage is not None:
+        return stages[stage].get()
+    return tuple(cached_stage.get() for cached_stage in stages.values())
+
+class _CachedStage:
+    """A processing stage whose result is cached on disk under a hash of its inputs, parameters and code."""
+
+    def __init__(self, cache_dir, name, upstream_key, params, compute):
+        key = json.dumps({'upstream': upstream_key, 'stage': name, 'params': params, 'code': _get_code_hash()},
+                         sort_keys=True, default=str)
+        self.key = hashlib.sha256(key.encode()).hexdigest()[:16]
+        self.path = f'{cache_dir}/{name}_{self.key}.pkl'
+        self._compute = compute
+        self._result = None
+
+    def get(self):
+        if self._result is None:
+            if os.path.exists(self.path):
+                self._result = pd.read_pickle(self.path)
+            else:
+                self._result = self._compute()
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                # Write to a temporary file first so an interrupted write isn't mistaken for a cached result.
+                self._result.to_pickle(f'{self.path}.tmp')
+                os.replace(f'{self.path}.tmp', self.path)
+        return self._result
+
+@lru_cache(maxsize=1)
+def _get_code_hash():
+    """A hash of this module's source, which the stages' results depend on."""
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
@@ -21,29 +21,31 @@ from sqlns_output_processing import *
 
 result_dir = '/share/costeffectiveness/results/sqlns/presentation/nigeria/2019_07_30_00_01_45'
 
-# Load outpt data - as of 2019-07-25 there are random seeds missing
-raw_output = load_output(result_dir, 'output.hdf')
-
-# Raw data aggregated by random seed, with intervention columns renamed
-r = clean_and_aggregate(raw_output)
-
-# Get results disaggregated by cause and aggregated over all causes
-output = get_all_results(r, cause_names)
+cause_names = ['lower_respiratory_infections', 'measles', 'diarrheal_diseases',
+               'protein_energy_malnutrition', 'iron_deficiency', 'other_causes']
 
-# join_columns = [c for c in template_cols if c not in ['cause', 'measure']]
-# Add person_time and sqlns_treated_days columns for each (scenario, draw, cause) combination
-df = output.merge(get_person_time(r), on=join_columns).merge(get_treated_days(r), on=join_columns)
+index_cols = ['coverage', 'duration', 'child_stunting_permanent',
+              'child_wasting_permanent', 'iron_deficiency_permanent',
+              'iron_deficiency_mean', 'input_draw']
 
+intervention_colname_mapper = {'sqlns.effect_on_child_stunting.permanent': 'child_stunting_permanent',
+                               'sqlns.effect_on_child_wasting.permanent': 'child_wasting_permanent',
+                               'sqlns.effect_on_iron_deficiency.permanent': 'iron_deficiency_permanent',
+                               'sqlns.effect_on_iron_deficiency.mean': 'iron_deficiency_mean',
+                               'sqlns.program_coverage': 'coverage',
+                               'sqlns.duration': 'duration'}
 
-## The previous 3 lines can be replaced with this new function:
-# df = get_transformed_data(raw_output)
-
-# Add columns for averted results
-averted_df = get_averted_results(df)
-
-# Aggregate over draws to compute mean and lower & upper percentiles
-# This code may take a couple minutes to run
-aggregated_results_df = get_final_table(averted_df)
+# Load outpt data - as of 2019-07-25 there are random seeds missing
+# Runs the whole chain:
+#   1. Raw data aggregated by random seed, with intervention columns renamed
+#   2. Results disaggregated by cause and aggregated over all causes, with person_time and
+#      sqlns_treated_days columns for each (scenario, draw, cause) combination
+#   3. Columns for averted results
+#   4. Aggregates over draws with mean and lower & upper percentiles
+# Each stage is cached next to the output file, so only the first run takes a couple minutes.
+r, output, averted_df, aggregated_results_df = process_output(
+    result_dir, 'output.hdf', intervention_colname_mapper, index_cols, 'coverage', cause_names)
+df = output
 
 # Get lists of draws, measures, and costs for interactive plots
 draws = r.reset_index().input_draw.unique()
@@ -0,0 +1,41 @@
+import pytest
+
+SEQUELAE = {'mild_iron_deficiency': 0.01, 'moderate_iron_deficiency': 0.05, 'severe_iron_deficiency': 0.15}
+
+
+@pytest.fixture
+def setup_simulation_with_data():
+    """Returns a function that sets up a simulation backed by the vph mock
+    artifact, with under 5 age bins, normally distributed hemoglobin and
+    iron deficiency sequelae added to it."""
+    import pandas as pd
+    from vivarium.interface.interactive import initialize_simulation
+    from vivarium.testing_utilities import build_table
+
+    plugins = {'optional': {'data': {
+        'controller': 'vivarium_public_health.testing.mock_artifact.MockArtifactManager',
+        'builder_interface': 'vivarium_public_health.dataset_manager.ArtifactManagerInterface'
+    }}}
+
+    def setup_simulation(components, config):
+        simulation = initialize_simulation(components, config, plugins)
+
+        simulation.data.write('population.age_bins', pd.DataFrame({
+            'age_group_name': ['early_neonatal', 'late_neonatal', 'post_neonatal', '1_to_4'],
+            'age_group_start': [0, 7 / 365, 28 / 365, 1],
+            'age_group_end': [7 / 365, 28 / 365, 1, 5],
+        }))
+        simulation.data.write('risk_factor.iron_deficiency.distribution', 'normal')
+        simulation.data.write('risk_factor.iron_deficiency.exposure',
+                              build_table([110, 'continuous'], 1990, 2030,
+                                          ('age', 'sex', 'year', 'value', 'parameter')))
+        simulation.data.write('risk_factor.iron_deficiency.exposure_standard_deviation',
+                              build_table(20, 1990, 2030))
+        simulation.data.write('cause.dietary_iron_deficiency.sequelae', list(SEQUELAE))
+        for sequela, weight in SEQUELAE.items():
+            simulation.data.write(f'sequela.{sequela}.disability_weight', build_table(weight, 1990, 2030))
+
+        simulation.setup()
+        return simulation
+
+    return setup_simulation
@@ -0,0 +1,102 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('vivarium_public_health')
+
+from vivarium.testing_utilities import TestPopulation
+
+from vivarium_conic_sqlns.components.iron_deficiency import (IronDeficiencyAnemia, get_anemia_thresholds,
+                                                             get_iron_deficiency_disability_weight)
+
+
+class LegacyAnemiaThresholds:
+    """Disability weights from the anemia thresholds as an interpolated
+    lookup table, as the model originally computed them."""
+
+    @property
+    def name(self):
+        return 'legacy_anemia_thresholds'
+
+    def setup(self, builder):
+        self.lookup = builder.lookup.build_table(
+            get_anemia_thresholds(),
+            key_columns=[],
+            parameter_columns=[('age', 'age_group_start', 'age_group_end')],
+            value_columns=['severe_threshold', 'moderate_threshold', 'mild_threshold']
+        )
+        self.disability_weight_data = builder.lookup.build_table(get_iron_deficiency_disability_weight(builder))
+        self.exposure = builder.value.get_value('iron_deficiency.exposure')
+        self.population_view = builder.population.get_view(['age'])
+
+    def get_disability_weight(self, index):
+        anemia = self.lookup(index)
+        hemoglobin = self.exposure(index)
+
+        disability_weight_data = self.disability_weight_data(index)
+
+        mild = (anemia.moderate_threshold <= hemoglobin) & (hemoglobin < anemia.mild_threshold)
+        moderate = (anemia.severe_threshold <= hemoglobin) & (hemoglobin < anemia.moderate_threshold)
+        severe = hemoglobin < anemia.severe_threshold
+
+        disability_weight = pd.Series(0., index=index)
+        disability_weight[mild] = disability_weight_data.loc[mild, 'mild']
+        disability_weight[moderate] = disability_weight_data.loc[moderate, 'moderate']
+        disability_weight[severe] = disability_weight_data.loc[severe, 'severe']
+        return disability_weight
+
+
+class HemoglobinShift:
+    """Shifts hemoglobin levels by a settable amount."""
+
+    def __init__(self):
+        self.shift = 0.
+
+    @property
+    def name(self):
+        return 'hemoglobin_shift'
+
+    def setup(self, builder):
+        builder.value.register_value_modifier('iron_deficiency.exposure', modifier=self.modify_exposure)
+
+    def modify_exposure(self, index, exposure):
+        return exposure + self.shift
+
+
+@pytest.fixture
+def simulation(setup_simulation_with_data):
+    config = {'time': {'start': {'year': 2020, 'month': 1, 'day': 1},
+                       'end': {'year': 2021, 'month': 1, 'day': 1},
+                       'step_size': 30},
+              'population': {'population_size': 1000, 'age_start': 0, 'age_end': 10},
+              'randomness': {'key_columns': ['entrance_time', 'age']}}
+    return setup_simulation_with_data([TestPopulation(), IronDeficiencyAnemia(), LegacyAnemiaThresholds(),
+                                       HemoglobinShift()], config)
+
+
+def test_disability_weight_matches_lookup_table(simulation):
+    disability_weight = simulation.get_value('iron_deficiency.disability_weight')
+    legacy = simulation.get_component('legacy_anemia_thresholds')
+    hemoglobin_shift = simulation.get_component('hemoglobin_shift')
+
+    for shift in [0., 10., -15., 5., 5., -20.]:
+        # Change hemoglobin levels between steps so cached severities go stale.
+        hemoglobin_shift.shift = shift
+        simulation.step()
+
+        index = simulation.get_population().index
+        expected = legacy.get_disability_weight(index)
+        assert expected.nunique() == 4
+        pd.testing.assert_series_equal(disability_weight(index), expected, check_names=False)
+
+
+def test_disability_weight_recomputed_when_age_changes(simulation):
+    disability_weight = simulation.get_value('iron_deficiency.disability_weight')
+    legacy = simulation.get_component('legacy_anemia_thresholds')
+    index = simulation.get_population().index
+    disability_weight(index)
+
+    # Move simulants across age groups without advancing the clock.
+    legacy.population_view.update(pd.Series(11 - simulation.get_population().age, index=index, name='age'))
+
+    pd.testing.assert_series_equal(disability_weight(index), legacy.get_disability_weight(index), check_names=False)
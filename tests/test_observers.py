@@ -0,0 +1,334 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('vivarium_public_health')
+
+from vivarium.testing_utilities import TestPopulation
+
+from vivarium_conic_sqlns.components.iron_deficiency import IronDeficiencyAnemia, get_anemia_thresholds
+from vivarium_conic_sqlns.components.observers import (DisabilityObserver, RiskObserver, SampleHistoryObserver,
+                                                       SQLNSObserver, read_sample_history)
+from vivarium_conic_sqlns.components.sq_lns_intervention import SQLNSTreatmentAlgorithm
+from vivarium_conic_sqlns.verification_and_validation.sqlns_output_processing import get_treated_days
+
+
+class Deaths:
+    """Kills every tenth simulant on each time step."""
+
+    @property
+    def name(self):
+        return 'deaths'
+
+    def setup(self, builder):
+        self.population_view = builder.population.get_view(['alive', 'exit_time'])
+        self.step = 0
+        builder.event.register_listener('time_step', self.on_time_step)
+
+    def on_time_step(self, event):
+        pop = self.population_view.get(event.index, query='alive == "alive"')
+        dead = pop.loc[pop.index % 10 == self.step % 10].index
+        self.population_view.update(pd.DataFrame({'alive': 'dead', 'exit_time': event.time}, index=dead))
+        self.step += 1
+
+
+def get_treated_days_from_population(pop):
+    """Total treated days as the observer originally computed them, from the whole population."""
+    treated = pop.loc[~pop['sqlns_treatment_start'].isnull()]
+    treatment_end = treated['sqlns_treatment_end'].copy()
+    died_before_treatment_end = treated['exit_time'] < treatment_end
+    treatment_end.loc[died_before_treatment_end] = treated.loc[died_before_treatment_end, 'exit_time']
+    return ((treatment_end - treated['sqlns_treatment_start']) / pd.Timedelta(days=1)).sum()
+
+
+@pytest.mark.parametrize('by_year, by_age', [(False, False), (True, True), (True, False), (False, True)])
+def test_treated_days_match_population_scan(setup_simulation_with_data, by_year, by_age):
+    config = {'time': {'start': {'year': 2019, 'month': 12, 'day': 1},
+                       'end': {'year': 2020, 'month': 6, 'day': 1},
+                       'step_size': 7},
+              'population': {'population_size': 1000, 'age_start': 0, 'age_end': 2},
+              'randomness': {'key_columns': ['entrance_time', 'age']},
+              'sqlns': {'program_coverage': 0.5},
+              'metrics': {'sqlns_observer': {'by_year': by_year, 'by_age': by_age}}}
+    simulation = setup_simulation_with_data([TestPopulation(), SQLNSTreatmentAlgorithm(), Deaths(),
+                                             SQLNSObserver()], config)
+    simulation.run()
+
+    pop = simulation.get_population()
+    expected = get_treated_days_from_population(pop)
+    assert expected > 0
+    assert (pop['exit_time'] < pop['sqlns_treatment_end']).any()
+
+    metrics = simulation.get_value('metrics')(pop.index)
+    treated_days = {key: value for key, value in metrics.items() if key.startswith('sqlns_treated_days')}
+    if by_year or by_age:
+        # Stratified runs only report the strata, not the total alongside them.
+        assert 'sqlns_treated_days' not in treated_days
+        assert len(treated_days) > 1
+    assert sum(treated_days.values()) == pytest.approx(expected)
+
+    data = pd.DataFrame([treated_days], index=pd.Index([0], name='input_draw'))
+    assert get_treated_days(data, ['input_draw'])['sqlns_treated_days'].sum() == pytest.approx(expected)
+
+
+class ModelPipelines:
+    """Registers the pipelines the sample history records that come from
+    components outside this test, with modifiers that reuse other pipelines
+    the way risk effects and disability weights do."""
+
+    @property
+    def name(self):
+        return 'model_pipelines'
+
+    def setup(self, builder):
+        self.population_view = builder.population.get_view(['age'])
+        for risk in ['child_stunting', 'child_wasting']:
+            builder.value.register_value_producer(f'{risk}.exposure', source=self.get_age_scaled(1 / 4),
+                                                  preferred_post_processor=self.to_category)
+        stunting = builder.value.get_value('child_stunting.exposure')
+
+        for i, cause in enumerate(['lower_respiratory_infections', 'diarrheal_diseases', 'measles']):
+            builder.value.register_rate_producer(f'{cause}.incidence_rate', source=self.get_age_scaled(i + 1))
+            builder.value.register_value_modifier(f'{cause}.incidence_rate',
+                                                  modifier=lambda index, rate: rate * (1 + stunting(index)))
+            self.register_disability_weight(builder, cause, self.get_age_scaled(0.01 * (i + 1)))
+        self.register_disability_weight(builder, 'protein_energy_malnutrition',
+                                        lambda index: 0.1 * builder.value.get_value('child_wasting.exposure')(index))
+
+    @staticmethod
+    def register_disability_weight(builder, cause, source):
+        disability_weight = builder.value.register_value_producer(f'{cause}.disability_weight', source=source)
+        builder.value.register_value_modifier('disability_weight', modifier=disability_weight)
+
+    def get_age_scaled(self, scale):
+        return lambda index: scale * self.population_view.get(index).age
+
+    @staticmethod
+    def to_category(exposure, _):
+        return exposure.round()
+
+
+class LegacySampleHistory:
+    """Records the sample history the way the observer originally did: one
+    call per pipeline and the state table as is."""
+
+    @property
+    def name(self):
+        return 'legacy_sample_history'
+
+    def __init__(self):
+        self.history_snapshots = []
+
+    def setup(self, builder):
+        self.observer = builder.components.get_component('sample_history_observer')
+        self.clock = builder.time.clock()
+        self.population_view = builder.population.get_view(['alive', 'age', 'sex', 'exit_time',
+                                                            'sqlns_treatment_start', 'sqlns_treatment_end'])
+        self.pipelines = {name: builder.value.get_value(pipeline) for name, pipeline in [
+            ('iron_deficiency_exposure', 'iron_deficiency.exposure'),
+            ('child_stunting_exposure', 'child_stunting.exposure'),
+            ('child_wasting_exposure', 'child_wasting.exposure'),
+            ('lower_resipratory_infections_incidence_rate', 'lower_respiratory_infections.incidence_rate'),
+            ('lower_resipratory_infections_disability_weight', 'lower_respiratory_infections.disability_weight'),
+            ('diarrheal_diseases_incidence_rate', 'diarrheal_diseases.incidence_rate'),
+            ('diarrheal_diseases_disability_weight', 'diarrheal_diseases.disability_weight'),
+            ('measles_incidence_rate', 'measles.incidence_rate'),
+            ('measles_disability_weight', 'measles.disability_weight'),
+            ('iron_deficiency_disability_weight', 'iron_deficiency.disability_weight'),
+            ('protein_energy_malnutrition_disability_weight', 'protein_energy_malnutrition.disability_weight'),
+            ('disability_weight', 'disability_weight'),
+        ]}
+        builder.event.register_listener('collect_metrics', self.record)
+
+    def record(self, event):
+        pop = self.population_view.get(self.observer.sample_index)
+        pipeline_results = []
+        for name, pipeline in self.pipelines.items():
+            values = pipeline(pop.index, skip_post_processor=name.endswith('_exposure')).rename(name)
+            pipeline_results.append(values)
+            if not name.endswith('disability_weight') and not name.endswith('_incidence_rate'):
+                pipeline_results.append(pipeline.source(pop.index).rename(f'{name}_baseline'))
+
+        record = pd.concat(pipeline_results + [pop], axis=1)
+        record['time'] = self.clock()
+        record.index.rename('simulant', inplace=True)
+        record.set_index('time', append=True, inplace=True)
+        self.history_snapshots.append(record)
+
+    def get_history(self):
+        return pd.concat(self.history_snapshots, axis=0)
+
+
+def setup_sample_history(setup_simulation_with_data, path, duration=365):
+    config = {'time': {'start': {'year': 2019, 'month': 12, 'day': 28},
+                       'end': {'year': 2020, 'month': 1, 'day': 8},
+                       'step_size': 1},
+              'population': {'population_size': 400, 'age_start': 0.3, 'age_end': 2},
+              'randomness': {'key_columns': ['entrance_time', 'age']},
+              'sqlns': {'program_coverage': 0.5, 'duration': duration},
+              'metrics': {'sample_history': {'sample_proportion': 0.25, 'path': str(path), 'flush_every': 3}}}
+    components = [TestPopulation(), SQLNSTreatmentAlgorithm(), IronDeficiencyAnemia(), ModelPipelines(),
+                  DisabilityObserver(), SampleHistoryObserver(), LegacySampleHistory()]
+    return setup_simulation_with_data(components, config)
+
+
+def assert_history_equal(history, expected):
+    assert history.index.equals(expected.index)
+    assert list(history.columns) == list(expected.columns)
+    for column in expected:
+        if expected[column].dtype == np.float64:
+            np.testing.assert_allclose(history[column].values, expected[column].values, rtol=1e-6)
+        else:
+            pd.testing.assert_series_equal(history[column], expected[column], check_dtype=False)
+
+
+def test_sample_history_appends_incrementally(setup_simulation_with_data, tmp_path):
+    path = tmp_path / 'sample_history.hdf'
+    # A table left by an earlier run is replaced, not appended to.
+    pd.DataFrame({'age': [1.0]}).to_hdf(str(path), key='sample_histories', format='table')
+
+    simulation = setup_sample_history(setup_simulation_with_data, path)
+    legacy = simulation.get_component('legacy_sample_history')
+
+    simulation.take_steps(7)
+    # Only whole buffers have been written, and the file can be read while the run goes on.
+    expected = legacy.get_history()
+    times = expected.index.get_level_values('time')
+    assert_history_equal(read_sample_history(path), expected[times.isin(times.unique()[:6])])
+
+    simulation.run()
+    simulation.finalize()
+    history = read_sample_history(path)
+    expected = legacy.get_history()
+    assert expected['sqlns_treatment_start'].notnull().any()
+    assert history.index.get_level_values('time').nunique() == 11
+    assert_history_equal(history, expected)
+
+
+def test_sample_history_keeps_treatment_times_off_the_step_grid(setup_simulation_with_data, tmp_path):
+    path = tmp_path / 'sample_history.hdf'
+    simulation = setup_sample_history(setup_simulation_with_data, path, duration=730.5)
+    simulation.run()
+    simulation.finalize()
+
+    history = read_sample_history(path)
+    treated = history['sqlns_treatment_end'].dropna()
+    assert not treated.empty
+    assert (treated - history.loc[treated.index, 'sqlns_treatment_start'] == pd.Timedelta(days=730.5)).all()
+    assert_history_equal(history, simulation.get_component('legacy_sample_history').get_history())
+
+
+def test_pipeline_batch_matches_pipeline_calls(setup_simulation_with_data, tmp_path):
+    simulation = setup_sample_history(setup_simulation_with_data, tmp_path / 'sample_history.hdf')
+    observer = simulation.get_component('sample_history_observer')
+
+    for _ in range(3):
+        simulation.step()
+        index = simulation.get_population().index
+        values, sources = observer.pipeline_batch.evaluate(index)
+
+        assert set(values) == set(sources) == set(observer.pipelines)
+        for name, pipeline in observer.pipelines.items():
+            expected = pipeline(index, skip_post_processor=name.endswith('_exposure'))
+            pd.testing.assert_series_equal(values[name], expected)
+
+            expected_source = pipeline.source(index)
+            if isinstance(expected_source, list):  # The disability weight list combiner.
+                assert len(sources[name]) == len(expected_source)
+                for source, expected in zip(sources[name], expected_source):
+                    pd.testing.assert_series_equal(source, expected)
+            else:
+                pd.testing.assert_series_equal(sources[name], expected_source)
+
+
+class CategoricalWasting:
+    """A categorical child wasting exposure drawn once per simulant."""
+
+    @property
+    def name(self):
+        return 'child_wasting'
+
+    def setup(self, builder):
+        self.randomness = builder.randomness.get_stream('child_wasting_category')
+        builder.value.register_value_producer('child_wasting.exposure', source=self.get_exposure)
+
+    def get_exposure(self, index):
+        return self.randomness.choice(index, ['cat1', 'cat2', 'cat3', 'cat4'])
+
+
+class LegacyYearlySamples:
+    """Keeps a sample frame per year for child wasting categories and anemia
+    severities, and labels them, as the observers originally did."""
+
+    def __init__(self):
+        self.risk_data = {}
+        self.anemia_data = {}
+
+    @property
+    def name(self):
+        return 'legacy_yearly_samples'
+
+    def setup(self, builder):
+        self.risk_observer = builder.components.get_component('categorical_risk_observer.risk_factor.child_wasting')
+        self.clock = builder.time.clock()
+        self.anemia_thresholds = builder.lookup.build_table(
+            get_anemia_thresholds(),
+            key_columns=[],
+            parameter_columns=[('age', 'age_group_start', 'age_group_end')],
+            value_columns=['severe_threshold', 'moderate_threshold', 'mild_threshold']
+        )
+        self.wasting = builder.value.get_value('child_wasting.exposure')
+        self.hemoglobin = builder.value.get_value('iron_deficiency.exposure')
+        self.population_view = builder.population.get_view(['alive', 'age'])
+        builder.event.register_listener('collect_metrics', self.on_collect_metrics)
+
+    def on_collect_metrics(self, event):
+        if not self.risk_observer.should_sample(self.clock()):
+            return
+        pop = self.population_view.get(event.index, query='alive == "alive"')
+
+        sample = pd.DataFrame({cat: 0 for cat in ['cat1', 'cat2', 'cat3', 'cat4']}, index=['0_to_5'])
+        sample.loc['0_to_5'] = self.wasting(pop.index).value_counts()
+        self.risk_data[self.clock().year] = sample
+
+        anemia = self.anemia_thresholds(pop.index)
+        hemoglobin = self.hemoglobin(pop.index)
+        mild = (anemia.moderate_threshold <= hemoglobin) & (hemoglobin < anemia.mild_threshold)
+        moderate = (anemia.severe_threshold <= hemoglobin) & (hemoglobin < anemia.moderate_threshold)
+        severe = hemoglobin < anemia.severe_threshold
+        sample = pd.DataFrame({'unexposed': 0, 'mild': 0, 'moderate': 0, 'severe': 0}, index=['0_to_5'])
+        sample.loc['0_to_5', 'mild'] = len(pop.loc[mild])
+        sample.loc['0_to_5', 'moderate'] = len(pop.loc[moderate])
+        sample.loc['0_to_5', 'severe'] = len(pop.loc[severe])
+        sample.loc['0_to_5', 'unexposed'] = len(pop) - (len(pop.loc[mild]) + len(pop.loc[moderate])
+                                                        + len(pop.loc[severe]))
+        self.anemia_data[self.clock().year] = sample
+
+    def metrics(self):
+        metrics = {}
+        for year, sample in self.risk_data.items():
+            for category in sample.columns:
+                metrics[f'child_wasting_{category}_exposed_in_{year}_among_0_to_5'] = sample.loc['0_to_5', category]
+        for year, sample in self.anemia_data.items():
+            for category in sample.columns:
+                metrics[f'anemia_{category}_in_{year}_among_0_to_5'] = sample.loc['0_to_5', category]
+        return metrics
+
+
+def test_sample_counts_match_yearly_samples(setup_simulation_with_data):
+    config = {'time': {'start': {'year': 2020, 'month': 1, 'day': 1},
+                       'end': {'year': 2022, 'month': 1, 'day': 1},
+                       'step_size': 30},
+              'population': {'population_size': 2000, 'age_start': 0, 'age_end': 5},
+              'randomness': {'key_columns': ['entrance_time', 'age']}}
+    simulation = setup_simulation_with_data([TestPopulation(), IronDeficiencyAnemia(), CategoricalWasting(),
+                                             RiskObserver('risk_factor.child_wasting'), LegacyYearlySamples()],
+                                            config)
+    simulation.run()
+
+    expected = simulation.get_component('legacy_yearly_samples').metrics()
+    assert len(expected) == 2 * (4 + 4)
+    metrics = simulation.get_value('metrics')(simulation.get_population().index)
+    assert {key: metrics[key] for key in expected} == expected
+    assert set(metrics) - set(expected) == {'total_population', 'total_population_tracked',
+                                            'total_population_untracked'}
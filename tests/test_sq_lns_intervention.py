@@ -0,0 +1,125 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('vivarium_public_health')
+
+from vivarium.interface.interactive import setup_simulation
+from vivarium.testing_utilities import TestPopulation
+
+from vivarium_conic_sqlns.components.sq_lns_intervention import (SQLNSTreatmentAlgorithm,
+                                                                 get_treatment_phase_and_scale, to_nanoseconds,
+                                                                 RAMP_DOWN)
+
+CLOCK = pd.Timestamp('2022-07-01')
+
+
+def get_population():
+    """Treatment starting on every day for two years (so some start and end exactly at the clock), and a
+    duration of one or two years, with every other simulant untreated."""
+    start = pd.Series(CLOCK - pd.to_timedelta(np.arange(2 * 366), unit='D'))
+    duration = pd.to_timedelta(np.where(np.arange(len(start)) % 3, 365, 730.5), unit='D')
+    start = start.where(np.arange(len(start)) % 2 == 0)
+    return pd.DataFrame({'sqlns_treatment_start': start, 'sqlns_treatment_end': start + duration})
+
+
+def legacy_effect_scale(pop, ramp, permanent):
+    """The original mask-based SQLNSEffect.adjust_exposure, for an effect size of 1."""
+    clock = CLOCK
+    ramp_time = pd.Timedelta(days=ramp)
+
+    def ramp_efficacy(idx, invert=False):
+        if idx.empty:
+            return pd.Series()
+        p = pop.loc[idx]
+        growth_rate = 2 / ramp * np.log(10_000)
+        if invert:
+            ramp_position = ((p['sqlns_treatment_end'] + ramp_time / 2) - clock) / pd.Timedelta(days=1)
+        else:
+            ramp_position = (clock - (p['sqlns_treatment_start'] + ramp_time / 2)) / pd.Timedelta(days=1)
+        return 1 / (1 + np.exp(-growth_rate * ramp_position))
+
+    effect_size = pd.Series(0., index=pop.index)
+    untreated = pop.loc[(pop['sqlns_treatment_start'].isnull())
+                        | (pop['sqlns_treatment_start'] <= clock)].index
+    ramp_up = pop.loc[(pop['sqlns_treatment_start'] < clock)
+                      & (clock < pop['sqlns_treatment_start'] + ramp_time)].index
+    full_treatment = pop.loc[(pop['sqlns_treatment_start'] + ramp_time <= clock)
+                             & (clock <= pop['sqlns_treatment_end'])].index
+    ramp_down = pop.loc[(pop['sqlns_treatment_end'] < clock)
+                        & (clock < pop['sqlns_treatment_end'] + ramp_time)].index
+    post_treatment = pop.loc[pop['sqlns_treatment_end'] + ramp_time <= clock].index
+
+    effect_size.loc[untreated] = 0
+    effect_size.loc[ramp_up] = ramp_efficacy(ramp_up)
+    effect_size.loc[full_treatment] = 1
+    if permanent:
+        effect_size.loc[ramp_down] = 1
+        effect_size.loc[post_treatment] = 1
+    else:
+        effect_size.loc[ramp_down] = ramp_efficacy(ramp_down, invert=True)
+        effect_size.loc[post_treatment] = 0
+    return effect_size.values
+
+
+@pytest.mark.parametrize('permanent', [False, True])
+@pytest.mark.parametrize('ramp', [0, 1, 60, 400])
+def test_treatment_scale_matches_legacy_masks(ramp, permanent):
+    pop = get_population()
+    phase, scale = get_treatment_phase_and_scale(to_nanoseconds(pop['sqlns_treatment_start']),
+                                                 to_nanoseconds(pop['sqlns_treatment_end']), CLOCK.value, ramp)
+    if permanent:
+        scale[phase >= RAMP_DOWN] = 1
+
+    np.testing.assert_allclose(scale, legacy_effect_scale(pop, ramp, permanent))
+
+
+class Births:
+    """Adds newborns on every time step."""
+
+    @property
+    def name(self):
+        return 'births'
+
+    def setup(self, builder):
+        self.simulant_creator = builder.population.get_simulant_creator()
+        builder.event.register_listener('time_step', self.on_time_step)
+
+    def on_time_step(self, event):
+        self.simulant_creator(20, population_configuration={'age_start': 0, 'age_end': 0,
+                                                            'sim_state': 'time_step'})
+
+
+class FullScanTreatmentAlgorithm(SQLNSTreatmentAlgorithm):
+    """Enrolls simulants by scanning the whole population on every time step, as the algorithm originally did."""
+
+    def on_time_step(self, event):
+        pop = self.pop_view.get(event.index, query="alive == 'alive'")
+        treated_idx = self.get_treated_idx(pop, event)
+
+        pop.loc[treated_idx, 'sqlns_treatment_start'] = event.time
+        pop.loc[treated_idx, 'sqlns_treatment_end'] = event.time + self.duration
+        self.pop_view.update(pop)
+
+
+def run_enrollment(treatment_algorithm, step_size):
+    config = {'time': {'start': {'year': 2019, 'month': 11, 'day': 1},
+                       'end': {'year': 2020, 'month': 9, 'day': 1},
+                       'step_size': step_size},
+              'population': {'population_size': 1000, 'age_start': 0, 'age_end': 1.5},
+              'randomness': {'key_columns': ['entrance_time', 'age']},
+              'sqlns': {'program_coverage': 0.5}}
+    simulation = setup_simulation([TestPopulation(), Births(), treatment_algorithm], config)
+    simulation.run()
+    return simulation.get_population()[['age', 'sqlns_treatment_start', 'sqlns_treatment_end']]
+
+
+@pytest.mark.parametrize('step_size', [3, 7, 10])
+def test_enrollment_queue_matches_full_scan(step_size):
+    expected = run_enrollment(FullScanTreatmentAlgorithm(), step_size)
+    actual = run_enrollment(SQLNSTreatmentAlgorithm(), step_size)
+
+    assert expected['sqlns_treatment_start'].notnull().sum() > 0
+    # Simulants born during the simulation enroll through the queue.
+    assert expected.loc[expected.index >= 1000, 'sqlns_treatment_start'].notnull().sum() > 0
+    pd.testing.assert_frame_equal(actual, expected)
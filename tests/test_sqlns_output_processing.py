@@ -0,0 +1,158 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+
+from vivarium_conic_sqlns.verification_and_validation import sqlns_output_processing as sop
+
+INDEX_COLS = ['coverage', 'input_draw']
+CAUSES = ['measles']
+
+
+def get_output():
+    """Aggregated output stratified by year and sex, with unstratified all-cause measures."""
+    index = pd.MultiIndex.from_product([[0.0, 50.0], [0, 1]], names=INDEX_COLS)
+    data = pd.DataFrame(index=index)
+    for year in [2020, 2021]:
+        for sex in ['male', 'female']:
+            strata = f'in_{year}_among_{sex}'
+            data[f'person_time_{strata}'] = [100., 110., 100., 110.]
+            data[f'sqlns_treated_days_{strata}'] = [0., 0., 20., 25.]
+            data[f'death_due_to_measles_{strata}'] = [4., 5., 3., 4.]
+            data[f'ylls_due_to_measles_{strata}'] = [40., 50., 30., 40.]
+            data[f'ylds_due_to_measles_{strata}'] = [1., 2., 1., 1.]
+    data['total_population_dead'] = [30., 31., 28., 29.]
+    data['years_of_life_lost'] = [300., 310., 280., 290.]
+    data['years_lived_with_disability'] = [10., 11., 9., 10.]
+    return data
+
+
+def test_transformed_data_keeps_unstratified_measures():
+    data = get_output()
+    all_results = sop.get_all_results(data, CAUSES, INDEX_COLS)
+    transformed = sop.get_transformed_data(data, CAUSES, INDEX_COLS)
+
+    assert len(transformed) == len(all_results)
+    all_causes = transformed[transformed['cause'] == 'all_causes']
+    assert len(all_causes) == 4 * 4  # deaths, YLLs, YLDs and DALYs for each scenario and draw
+    assert (all_causes[['year', 'sex']] == sop.UNSTRATIFIED).all().all()
+    # Person time and treated days for unstratified measures are the totals over every stratum.
+    totals = all_causes.groupby(INDEX_COLS)[['person_time', 'sqlns_treated_days']].agg(['min', 'max'])
+    assert totals['person_time']['min'].tolist() == totals['person_time']['max'].tolist() == [400., 440., 400., 440.]
+    assert totals['sqlns_treated_days']['max'].tolist() == [0., 0., 80., 100.]
+
+
+def get_long_results():
+    """Draw-level results with a stratified measure and an unstratified one (missing strata)."""
+    rows = []
+    for coverage in [0.0, 50.0]:
+        for draw in [0, 1]:
+            for year in [2020, 2021]:
+                rows.append({'coverage': coverage, 'input_draw': draw, 'cause': 'measles', 'measure': 'death',
+                             'year': str(year), 'value': 10. - coverage / 10 + draw})
+            rows.append({'coverage': coverage, 'input_draw': draw, 'cause': 'all_causes', 'measure': 'death',
+                         'year': np.nan, 'value': 100. - coverage / 10 + draw})
+    data = pd.DataFrame(rows)
+    data['year'] = data['year'].astype('category')
+    data['person_time'] = 1000.
+    data['sqlns_treated_days'] = data['coverage'] * 2
+    return data
+
+
+def test_averted_results_with_unstratified_measure():
+    averted = sop.get_averted_results(get_long_results(), INDEX_COLS, 'coverage')
+
+    assert len(averted) == 12
+    all_causes = averted[averted['cause'] == 'all_causes']
+    assert (all_causes['year'] == sop.UNSTRATIFIED).all()
+    assert all_causes['averted'].tolist() == [0., 0., 5., 5.]
+    assert averted.loc[averted['cause'] == 'measles', 'averted'].tolist() == [0.] * 4 + [5.] * 4
+
+    summary = sop.summarize_draws(averted, ['coverage', 'cause', 'year'], ['averted'])
+    assert len(summary) == 6
+    assert summary['count'].tolist() == [2.] * 6
+
+
+def test_missing_key_values_rejected():
+    data = get_long_results()
+    data.loc[0, 'input_draw'] = np.nan
+    with pytest.raises(ValueError, match='input_draw'):
+        sop.get_averted_results(data, INDEX_COLS, 'coverage')
+    with pytest.raises(ValueError, match='input_draw'):
+        sop.summarize_draws(data, ['coverage', 'input_draw'], ['value'])
+
+
+def test_cached_stage_key_depends_on_code(tmpdir, monkeypatch):
+    stage = sop._CachedStage(str(tmpdir), 'stage', 'upstream', {}, lambda: pd.DataFrame())
+    assert sop._CachedStage(str(tmpdir), 'stage', 'upstream', {}, lambda: pd.DataFrame()).key == stage.key
+
+    monkeypatch.setattr(sop, '_get_code_hash', lambda: 'changed')
+    assert sop._CachedStage(str(tmpdir), 'stage', 'upstream', {}, lambda: pd.DataFrame()).key != stage.key
+
+
+@pytest.mark.parametrize('max_workers', [1, None])
+def test_load_by_location_reads_only_requested_columns(tmpdir, max_workers):
+    outputs = {}
+    for i, location in enumerate(['Mali', 'Nigeria']):
+        output = get_output().reset_index()
+        output['sqlns.program_coverage'] = output.pop('coverage')
+        output['random_seed'] = i
+        run_directory = tmpdir.mkdir(location.lower()).mkdir('2019_07_30')
+        output.to_hdf(str(run_directory.join('output.hdf')), key='data')
+        outputs[location] = output
+
+    columns = ['input_draw', 'sqlns.program_coverage', 'death_due_to_measles_in_2020_among_male']
+    loaded = sop.load_by_location_and_rundate(str(tmpdir), {'Nigeria': '2019_07_30', 'Mali': '2019_07_30'},
+                                              columns=columns, max_workers=max_workers)
+
+    expected = pd.concat([outputs['Nigeria'][columns], outputs['Mali'][columns]])
+    pd.testing.assert_frame_equal(loaded[columns], expected)
+    assert loaded['location'].tolist() == ['Nigeria'] * 4 + ['Mali'] * 4
+    # The fixed format files were read through table format copies.
+    assert tmpdir.join('mali', '2019_07_30', 'output_table.hdf').check()
+
+
+def test_process_output_loads_only_the_requested_stage(tmpdir, monkeypatch):
+    output = get_output().reset_index()
+    output['sqlns.program_coverage'] = output.pop('coverage') / 100
+    output = pd.concat([output.assign(random_seed=seed) for seed in [0, 1]], ignore_index=True)
+    output.to_hdf(str(tmpdir.join('output.hdf')), key='data')
+    args = (str(tmpdir), 'output.hdf', {'sqlns.program_coverage': 'coverage'}, INDEX_COLS, 'coverage', CAUSES)
+
+    aggregated, transformed, averted, final = sop.process_output(*args)
+
+    read = []
+    read_pickle = pd.read_pickle
+    monkeypatch.setattr(pd, 'read_pickle', lambda path: read.append(os.path.basename(path)) or read_pickle(path))
+    pd.testing.assert_frame_equal(sop.process_output(*args, stage='final'), final)
+    assert [name.split('_')[0] for name in read] == ['final']
+
+    # Only the stages downstream of a missing cache are recomputed, from the nearest cached one.
+    for name in read:
+        tmpdir.join('processing_cache', name).remove()
+    read.clear()
+    pd.testing.assert_frame_equal(sop.process_output(*args, stage='final'), final)
+    assert [name.split('_')[0] for name in read] == ['averted']
+
+
+@pytest.mark.parametrize('chunksize', [3, 5, 100])
+def test_chunked_aggregation_matches_clean_and_aggregate(tmpdir, chunksize):
+    rs = np.random.RandomState(0)
+    rows = 40
+    output = pd.DataFrame({'sqlns.program_coverage': rs.choice([0., 0.2, 0.5], rows),
+                           'sqlns.duration': rs.choice([365.25, 730.5], rows),
+                           'input_draw': rs.choice([0, 1], rows),
+                           'random_seed': np.arange(rows),
+                           'deaths': rs.uniform(0, 10, rows),
+                           'person_time': rs.randint(0, 1000, rows)})
+    # Rows with a missing branch value, including the first row of chunks.
+    output.loc[[0, 3, 4, 17, 30], 'sqlns.duration'] = np.nan
+    output.to_hdf(str(tmpdir.join('output.hdf')), key='data', format='table')
+    args = ({'sqlns.program_coverage': 'coverage', 'sqlns.duration': 'duration'},
+            ['coverage', 'duration', 'input_draw'], 'coverage')
+
+    expected = sop.clean_and_aggregate(sop.load_output(str(tmpdir), 'output.hdf'), *args)
+    chunked = sop.aggregate_output_by_chunks(str(tmpdir), 'output.hdf', *args, chunksize=chunksize)
+    pd.testing.assert_frame_equal(chunked[expected.columns], expected)
@@ -0,0 +1,32 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+
+from vivarium_conic_sqlns.scratch_notebooks.sqlns_summarizer import with_float_block
+
+
+def test_float_block_reuses_all_float_data():
+    data = pd.DataFrame(np.arange(12.).reshape(4, 3), columns=['a', 'b', 'c'])
+
+    block_data, values = with_float_block(data)
+
+    assert block_data is data
+    assert np.shares_memory(values, data['b'].values)
+    assert not values.flags.writeable
+    data.loc[0, 'b'] = -1.
+    assert values[0, 1] == -1.
+
+
+def test_float_block_copies_mixed_data():
+    data = pd.DataFrame({'a': [1., 2.], 'location': ['x', 'y'], 'b': [3., 4.], 'n': [5, 6]})
+
+    block_data, values = with_float_block(data)
+
+    pd.testing.assert_frame_equal(block_data, data)
+    assert np.array_equal(values, data[['a', 'b']].values)
+    assert not np.shares_memory(values, data['a'].values)
+    assert np.shares_memory(values, block_data['b'].values)
+    assert not values.flags.writeable
+    with pytest.raises(ValueError):
+        values[0, 0] = 0.
@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('vivarium_public_health')
+
+from vivarium_conic_sqlns.components.utilities import SamplingSchedule
+
+
+class FakeTime(dict):
+
+    def to_dict(self):
+        return dict(self)
+
+
+def get_builder(start, end, step_days):
+    time = {'start': FakeTime(year=start.year, month=start.month, day=start.day),
+            'end': FakeTime(year=end.year, month=end.month, day=end.day)}
+    step_size = pd.Timedelta(days=step_days)
+    return SimpleNamespace(configuration={'time': time},
+                           time=SimpleNamespace(step_size=lambda: lambda: step_size))
+
+
+def test_sampling_schedule_excludes_step_starting_at_end():
+    # With weekly steps from 2020-01-01 a step would start on 2023-12-27 and
+    # span the Jan 1 sample date, but the simulation ends before running it.
+    end = pd.Timestamp('2023-12-27')
+    schedule = SamplingSchedule(get_builder(pd.Timestamp('2020-01-01'), end, 7), {'month': 1, 'day': 1})
+
+    assert schedule.years == [2020, 2021, 2022]
+    assert not schedule.should_sample(end)
+    assert schedule.should_sample(pd.Timestamp('2022-12-28'))
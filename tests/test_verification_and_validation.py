@@ -0,0 +1,118 @@
+from collections import Counter
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('vivarium_public_health')
+
+from vivarium.testing_utilities import TestPopulation
+from vivarium_public_health.metrics.utilities import (get_age_bins, get_age_sex_filter_and_iterables,
+                                                      get_output_template)
+
+from vivarium_conic_sqlns.components.iron_deficiency import get_anemia_thresholds
+from vivarium_conic_sqlns.components.verification_and_validation import VVIronDeficiencyAnemia, VVRiskObserver
+
+CATEGORIES = ['cat1', 'cat2', 'cat3', 'cat4']
+
+
+class ChildWasting:
+    """A categorical child wasting exposure drawn once per simulant, with
+    some simulants in a category the observer isn't configured for."""
+
+    @property
+    def name(self):
+        return 'child_wasting'
+
+    def setup(self, builder):
+        self.randomness = builder.randomness.get_stream('child_wasting_category')
+        builder.value.register_value_producer('child_wasting.exposure', source=self.get_exposure)
+
+    def get_exposure(self, index):
+        return self.randomness.choice(index, CATEGORIES + ['cat5'])
+
+
+class LegacyStratifiedCounts:
+    """Counts risk categories and anemia severities by querying the
+    population once per age group and sex, as the observers originally did."""
+
+    def __init__(self):
+        self.category_counts = Counter()
+        self.anemia_counts = Counter()
+
+    @property
+    def name(self):
+        return 'legacy_stratified_counts'
+
+    def setup(self, builder):
+        self.risk_observer = builder.components.get_component('vv_categorical_risk_observer.risk_factor.child_wasting')
+        self.risk_config = builder.configuration.metrics.child_wasting_observer
+        self.anemia_config = builder.configuration.metrics.anemia_observer
+        self.age_bins = get_age_bins(builder)
+        self.clock = builder.time.clock()
+        self.anemia_thresholds = builder.lookup.build_table(
+            get_anemia_thresholds(),
+            key_columns=[],
+            parameter_columns=[('age', 'age_group_start', 'age_group_end')],
+            value_columns=['severe_threshold', 'moderate_threshold', 'mild_threshold']
+        )
+        self.wasting = builder.value.get_value('child_wasting.exposure')
+        self.hemoglobin = builder.value.get_value('iron_deficiency.exposure')
+        self.population_view = builder.population.get_view(['alive', 'age', 'sex'])
+        builder.event.register_listener('collect_metrics', self.on_collect_metrics)
+
+    def on_collect_metrics(self, event):
+        if not self.risk_observer.should_sample(self.clock()):
+            return
+        pop = self.population_view.get(event.index, query='alive == "alive"')
+        exposure = self.wasting(pop.index)
+        year = self.clock().year
+
+        for filter_kwargs, in_group in self.get_groups(pop, self.risk_config):
+            for cat in CATEGORIES:
+                base_key = get_output_template(**self.risk_config).substitute(
+                    measure=f'child_wasting_{cat}_exposed', year=year)
+                self.category_counts[base_key.substitute(**filter_kwargs)] += (exposure.loc[in_group.index]
+                                                                               == cat).sum()
+
+        for filter_kwargs, in_group in self.get_groups(pop, self.anemia_config):
+            anemia = self.anemia_thresholds(in_group.index)
+            hemoglobin = self.hemoglobin(in_group.index)
+            levels = {'mild': (anemia.moderate_threshold <= hemoglobin) & (hemoglobin < anemia.mild_threshold),
+                      'moderate': (anemia.severe_threshold <= hemoglobin) & (hemoglobin < anemia.moderate_threshold),
+                      'severe': hemoglobin < anemia.severe_threshold}
+            levels['unexposed'] = ~(levels['mild'] | levels['moderate'] | levels['severe'])
+            for level, idx in levels.items():
+                base_key = get_output_template(**self.anemia_config).substitute(
+                    measure=f'{level}_anemia_counts', year=year)
+                self.anemia_counts[base_key.substitute(**filter_kwargs)] += len(in_group[idx])
+
+    def get_groups(self, pop, config):
+        age_sex_filter, (ages, sexes) = get_age_sex_filter_and_iterables(config, self.age_bins)
+        for group, age_group in ages:
+            start, end = age_group.age_group_start, age_group.age_group_end
+            for sex in sexes:
+                filter_kwargs = {'age_group_start': start, 'age_group_end': end, 'sex': sex, 'age_group': group}
+                group_filter = age_sex_filter.format(**filter_kwargs)
+                yield filter_kwargs, pop.query(group_filter) if group_filter and not pop.empty else pop
+
+
+@pytest.mark.parametrize('by_age, by_sex', [(True, True), (True, False), (False, True), (False, False)])
+def test_stratified_counts_match_population_queries(setup_simulation_with_data, by_age, by_sex):
+    strata = {'by_age': by_age, 'by_sex': by_sex}
+    config = {'time': {'start': {'year': 2020, 'month': 6, 'day': 1},
+                       'end': {'year': 2021, 'month': 8, 'day': 1},
+                       'step_size': 30},
+              'population': {'population_size': 2000, 'age_start': 0, 'age_end': 5},
+              'randomness': {'key_columns': ['entrance_time', 'age']},
+              'metrics': {'anemia_observer': strata, 'child_wasting_observer': strata}}
+    simulation = setup_simulation_with_data([TestPopulation(), VVIronDeficiencyAnemia(), ChildWasting(),
+                                             VVRiskObserver('risk_factor.child_wasting'), LegacyStratifiedCounts()],
+                                            config)
+    simulation.run()
+
+    legacy = simulation.get_component('legacy_stratified_counts')
+    metrics = simulation.get_value('metrics')(simulation.get_population().index)
+    for expected, measure in [(legacy.category_counts, '_exposed'), (legacy.anemia_counts, '_anemia_counts')]:
+        assert sum(expected.values()) > 0
+        assert {key: value for key, value in metrics.items() if measure in key} == expected